@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+
+# =====================
+# 品質ティア
+# =====================
+# 上から順に高品質。max_queue は「待ちジョブ数がこれ以下なら使える」上限
+DEFAULT_QUALITY_TIERS = [
+    {"name": "full", "steps": 35, "width": 512, "height": 512, "sampler": None, "max_queue": 4},
+    {"name": "balanced", "steps": 20, "width": 512, "height": 512, "sampler": "Euler a", "max_queue": 16},
+    {"name": "fast", "steps": 12, "width": 448, "height": 448, "sampler": "Euler a", "max_queue": 64},
+    {"name": "minimal", "steps": 8, "width": 384, "height": 384, "sampler": "Euler a", "max_queue": None},
+]
+
+# JSON で上書きできる（形式は DEFAULT_QUALITY_TIERS と同じ）
+QUALITY_TIERS = json.loads(os.getenv("QUALITY_TIERS", "null")) or DEFAULT_QUALITY_TIERS
+# SD の所要時間（指数移動平均）がこれを超えたら1段下げる
+QUALITY_LATENCY_TARGET_SEC = float(os.getenv("QUALITY_LATENCY_TARGET_SEC", "30"))
+
+FULL_TIER = QUALITY_TIERS[0]
+
+_lock = threading.Lock()
+_latency_sec_ewma = None
+_selected = {tier["name"]: 0 for tier in QUALITY_TIERS}
+
+
+# =====================
+# 計測
+# =====================
+def record_latency(seconds: float):
+    """SD 1回分の所要時間を記録する"""
+    global _latency_sec_ewma
+    with _lock:
+        if _latency_sec_ewma is None:
+            _latency_sec_ewma = seconds
+        else:
+            _latency_sec_ewma = 0.8 * _latency_sec_ewma + 0.2 * seconds
+
+
+# =====================
+# ティア選択
+# =====================
+def choose_tier(queue_depth: int) -> dict:
+    """待ちジョブ数と最近の SD 所要時間から使うティアを決める"""
+    index = len(QUALITY_TIERS) - 1
+    for i, tier in enumerate(QUALITY_TIERS):
+        if tier["max_queue"] is None or queue_depth <= tier["max_queue"]:
+            index = i
+            break
+
+    with _lock:
+        if (
+            _latency_sec_ewma is not None
+            and _latency_sec_ewma > QUALITY_LATENCY_TARGET_SEC
+        ):
+            index = min(index + 1, len(QUALITY_TIERS) - 1)
+
+        tier = QUALITY_TIERS[index]
+        _selected[tier["name"]] += 1
+    return tier
+
+
+def is_degraded(tier: dict) -> bool:
+    return tier["name"] != FULL_TIER["name"]
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "latency_sec_ewma": _latency_sec_ewma,
+            "selected": dict(_selected),
+        }
@@ -1,19 +1,42 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, Response
+# .env は設定を読むモジュールより先に読み込む
+import envConfig  # noqa: F401
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import contextvars
 import datetime
+import hashlib
+import json
 import os
-import base64
-import requests
-from dotenv import load_dotenv
+import shutil
+import tempfile
+import threading
+import time
 import google.generativeai as genai
-from typing import Dict
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
 
 
-# Firebase
+# Firebase（DATASTORE_BACKEND でローカルの保存先にも切り替えられる）
 import databaseConnect
+import jobQueue
+import llmGateway
+import verdictCache
+import cardCache
+import profileCache
+import heyCounter
+import sdClient
+import admissionControl
+import cardVariants
+import metrics
+import eventBus
+import leaderboard
+import referenceData
+import evidenceSearch
 
 # =====================
 # FastAPI 初期化
@@ -21,9 +44,17 @@ import databaseConnect
 app = FastAPI(title="Profile + Trivia + Card API")
 
 databaseConnect.initialize()
-db = databaseConnect.get_db()
+store = databaseConnect.get_store()
 bucket = databaseConnect.get_bucket()
 
+# ローカルの保存先では画像もこのサーバーから返す
+if databaseConnect.is_local():
+    app.mount(
+        "/local-storage",
+        StaticFiles(directory=databaseConnect.LOCAL_STORAGE_DIR),
+        name="local-storage",
+    )
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -31,13 +62,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
 # =====================
-# Stable Diffusion API（同一 ngrok）
+# 計測（Server-Timing・/metrics・遅いリクエストのログ）
 # =====================
-SD_API_URL = "http://127.0.0.1:7860/sdapi/v1/txt2img"
-SD_AUTH = ("user", "password")  # 必要な場合のみ
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    token = metrics.begin()
+    metrics.gauge_add("http_requests_in_flight", 1)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = metrics.end(token)
+        metrics.gauge_add("http_requests_in_flight", -1)
+
+        # /jobs/{job_id} などはパスのテンプレートでまとめる
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.inc("http_requests_total", method=request.method, path=path, status=status)
+        metrics.observe("http_request_duration_seconds", elapsed, method=request.method, path=path)
+        metrics.log_if_slow(f"{request.method} {request.url.path} {status}", elapsed, timings)
+
+    response.headers["Server-Timing"] = metrics.server_timing(timings, elapsed)
+    return response
 
 # =====================
 # リクエストモデル
@@ -63,17 +116,134 @@ class heycount(BaseModel):
     ver: int
     pushedhey:int
 
+class heycountBatch(BaseModel):
+    items: List[heycount]
+
+class encounterItem(BaseModel):
+    peer_id: str
+    peer_ver: int
+    timestamp: int  # すれ違った日時（ミリ秒）
+
+class encounterBatch(BaseModel):
+    observer: str
+    encounters: List[encounterItem]
+
+# =====================
+# プロフィールのキャッシュ
+# =====================
+def remember_profiles(stored: list) -> list:
+    """保存先から読んだプロフィールをキャッシュに入れ、hey（未書き込み分を含む）を付けて返す"""
+    totals = heyCounter.record_totals(stored)
+
+    profiles = []
+    for data in stored:
+        data = dict(data)
+        data.pop("hey", None)
+        data.pop("updated_at", None)
+
+        payload = jsonable_encoder(data)
+        key = (data.get("id"), data.get("ver"))
+        profileCache.put(key[0], key[1], payload)
+        profiles.append({**payload, "hey": totals[key]})
+    return profiles
+
+async def refresh_hey(payloads: dict) -> dict:
+    """{(id, ver): payload}。変わらない部分はキャッシュのまま、hey だけを保存先から読み直して足す"""
+    stored = await store.aget_hey_totals(list(payloads))
+    totals = heyCounter.record_totals(
+        [{"id": key[0], "ver": key[1], "hey": hey} for key, hey in stored.items()]
+    )
+    return {key: {**payloads[key], "hey": hey} for key, hey in totals.items()}
+
+async def load_profile(user_id: str, ver: int) -> dict | None:
+    return (await load_profiles([(user_id, ver)])).get((user_id, ver))
+
+async def load_profiles(keys: list) -> dict:
+    """{(id, ver): profile}。キャッシュにないものだけ保存先からまとめて取る"""
+    profiles = {}
+    # 変わらない部分はあるが hey の期限が切れたもの
+    stale = {}
+    missing = []
+    for user_id, ver in keys:
+        payload = profileCache.get(user_id, ver)
+        if payload is None:
+            missing.append((user_id, ver))
+            continue
+        hey = profileCache.get_hey(user_id, ver)
+        if hey is None:
+            stale[(user_id, ver)] = payload
+        else:
+            profiles[(user_id, ver)] = {**payload, "hey": hey}
+
+    if stale:
+        profiles.update(await refresh_hey(stale))
+        # hey が読めなかった（消えた）ものはプロフィールごと読み直す
+        missing += [key for key in stale if key not in profiles]
+
+    stored = await store.aget_profiles(missing) if missing else {}
+    for profile in remember_profiles(list(stored.values())):
+        profiles[(profile["id"], profile["ver"])] = profile
+
+    return profiles
+
+# =====================
+# ETag
+# =====================
+def etag_response(request: Request, content) -> Response:
+    """強い ETag を付け、If-None-Match が一致すれば 304 を返す"""
+    body = json.dumps(
+        content, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    if etag in candidates or "*" in candidates:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# =====================
+# Gemini
+# =====================
+# SD プロンプトに必ず含める単語
+SD_PROMPT_REQUIRED = ("Hand-drawn", "Deformed", "Pastel colors")
+
+# フォールバック時に2つの呼び出しを並列に投げる用
+_llm_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm")
+
+# =====================
+# Web 検索の根拠（SEARCH_API / SEARCH_API_URL があれば）
+# =====================
+def evidence_section(trivia: str) -> str:
+    """判定プロンプトに差し込む検索結果（使わない・見つからないときは空）"""
+    if not evidenceSearch.enabled():
+        return ""
+    try:
+        evidence = evidenceSearch.gather(trivia)
+    except Exception as e:
+        print(f"evidence search failed: {e}")
+        return ""
+    if not evidence:
+        return ""
+    return (
+        "\n            【検索で見つかった情報（参考・誤りを含むことがあります）】\n"
+        + evidenceSearch.format_evidence(evidence)
+        + "\n"
+    )
+
 # =====================
 # Gemini：トリビア真偽判定
 # =====================
-def trivia_trueorfalse(trivia: str) -> bool | None:
-    load_dotenv(override=True)
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
+def trivia_trueorfalse(trivia: str, evidence: str | None = None) -> bool | None:
+    """evidence は集め済みの検索結果（None なら検索する）"""
+    cached = verdictCache.get(trivia)
+    if cached is not None:
+        return cached
 
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
+    if evidence is None:
+        evidence = evidence_section(trivia)
 
     prompt = f"""
             あなたはファクトチェッカーです。
@@ -82,43 +252,132 @@ def trivia_trueorfalse(trivia: str) -> bool | None:
             【ルール】
             ・出力は True または False のみ
             ・理由、説明、補足は禁止
-
+            {evidence}
             【検証対象】
             {trivia}
             """
 
-    text = model.generate_content(prompt).text.strip()
+    text = llmGateway.generate_text(prompt)
     if text == "True":
-        return True
-    if text == "False":
-        return False
-    return None
+        verdict = True
+    elif text == "False":
+        verdict = False
+    else:
+        verdict = None
+
+    verdictCache.put(trivia, verdict)
+    return verdict
 
 # =====================
-# 画像生成（Gemini → SD）
+# Gemini：SD 用プロンプト生成
 # =====================
-def generate_image(trivia: str, steps: int, width: int, height: int) -> bytes:
-    load_dotenv(override=True)
-
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
-
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
-
-    # ① Geminiでプロンプト生成
-    prompt_response = model.generate_content(
+def generate_sd_prompt(trivia: str) -> str:
+    return llmGateway.generate_text(
         trivia +
         "\n以下のルールに従ってください：\n"
         "・出力は1行のみ\n"
         "・英単語のみ、カンマ区切り\n"
-        "・必ず含める：Hand-drawn, Deformed, Pastel colors"
+        "・必ず含める：" + ", ".join(SD_PROMPT_REQUIRED)
+    )
+
+# =====================
+# Gemini：真偽判定 + SD プロンプトを1回で取得
+# =====================
+TRIVIA_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "verdict": {
+            "type": "STRING",
+            "description": "True / False / Unknown のいずれか",
+        },
+        "sd_prompt": {
+            "type": "STRING",
+            "description": "Stable Diffusion 用の英単語カンマ区切りプロンプト（1行）",
+        },
+    },
+    "required": ["verdict", "sd_prompt"],
+}
+
+def parse_trivia_analysis(text: str) -> tuple[bool | None, str]:
+    """構造化出力を厳密に検証する。形式が違えば ValueError"""
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("analysis is not an object")
+
+    verdict = data.get("verdict")
+    if verdict not in ("True", "False", "Unknown"):
+        raise ValueError(f"invalid verdict: {verdict!r}")
+
+    sd_prompt = data.get("sd_prompt")
+    if not isinstance(sd_prompt, str) or not sd_prompt.strip():
+        raise ValueError("sd_prompt is empty")
+
+    # 1行にまとめ、必須単語が抜けていれば補う
+    sd_prompt = ", ".join(
+        part.strip()
+        for part in sd_prompt.replace("\n", ",").split(",")
+        if part.strip()
     )
+    missing = [w for w in SD_PROMPT_REQUIRED if w.lower() not in sd_prompt.lower()]
+    if missing:
+        sd_prompt = ", ".join([sd_prompt, *missing])
+
+    is_true = {"True": True, "False": False, "Unknown": None}[verdict]
+    return is_true, sd_prompt
+
+def analyze_trivia(trivia: str) -> tuple[bool | None, str]:
+    """
+    真偽判定と SD プロンプトを1回の構造化出力リクエストで取得する。
+    失敗・形式不正のときは従来の2リクエストを並列に実行する。
+    判定がキャッシュ済みならプロンプト生成だけを行う。
+    """
+    cached = verdictCache.get(trivia)
+    if cached is not None:
+        return cached, generate_sd_prompt(trivia)
+
+    # 検索は判定の前に1往復だけ（クエリは並列）
+    evidence = evidence_section(trivia)
+
+    prompt = f"""
+            あなたはファクトチェッカー兼イラストのプロンプト作成者です。
+            以下の文について JSON で回答してください。
+
+            【ルール】
+            ・verdict：文が事実として正しければ "True"、誤りなら "False"、判断できなければ "Unknown"
+            ・sd_prompt：文の内容を表すイラスト用プロンプト
+              - 1行、英単語のみ、カンマ区切り
+              - 必ず含める：{", ".join(SD_PROMPT_REQUIRED)}
+            {evidence}
+            【検証対象】
+            {trivia}
+            """
+
+    try:
+        response = llmGateway.generate(
+            prompt,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=TRIVIA_ANALYSIS_SCHEMA,
+            ),
+        )
+        is_true, sd_prompt = parse_trivia_analysis(response.text)
+        verdictCache.put(trivia, is_true)
+        return is_true, sd_prompt
+    except Exception as e:
+        print(f"structured analysis failed, falling back: {e}")
 
-    prompt_text = prompt_response.text.strip()
+    # 計測の内訳に載るよう呼び出し元のコンテキストで実行する
+    # 検索結果は集め済みのものを使う（検索の往復を増やさない）
+    verdict_future = _llm_executor.submit(
+        contextvars.copy_context().run, trivia_trueorfalse, trivia, evidence
+    )
+    prompt_future = _llm_executor.submit(contextvars.copy_context().run, generate_sd_prompt, trivia)
+    return verdict_future.result(), prompt_future.result()
 
-    # ② Stable Diffusion
+# =====================
+# 画像生成（SD）
+# =====================
+def build_sd_payload(prompt_text: str, steps: int, width: int, height: int, sampler: str | None = None) -> dict:
     payload = {
         "prompt": prompt_text,
         "negative_prompt": (
@@ -129,98 +388,302 @@ def generate_image(trivia: str, steps: int, width: int, height: int) -> bytes:
         ),
         "steps": steps,
         "width": width,
-        "height": height
+        "height": height,
+        "seed": cardCache.pinned_seed(prompt_text),
     }
+    if sampler:
+        payload["sampler_name"] = sampler
+    return payload
 
-    r = requests.post(
-        SD_API_URL,
-        json=payload,
-        auth=SD_AUTH,
-        timeout=180
-    )
-    r.raise_for_status()
-
-    img_base64 = r.json()["images"][0]
-    return base64.b64decode(img_base64)
+@metrics.timed("sd.txt2img")
+def generate_image(payload: dict):
+    """
+    画像をファイルオブジェクト（先頭位置）で返す。
+    SD のレスポンスは少しずつデコードし、全体をメモリに載せない。
+    接続先・振り分けは sdClient（SD_BACKENDS）で設定する。
+    """
+    return sdClient.txt2img_stream(payload)
 
 
 # =====================
-# Firebase Storage
+# Firebase Storage（ローカルの保存先では LOCAL_STORAGE_DIR）
 # =====================
-def upload_image_to_storage(image_bytes: bytes, filename: str) -> str:
+@metrics.timed("storage.upload")
+def upload_image_to_storage(image_file, filename: str) -> str:
+    # 公開設定はアップロードと同じリクエストで行う（make_public の往復を省く）。
+    # size を渡さないと resumable（開始 + 送信の2往復）になるので、1回の multipart にする
+    start = image_file.tell()
+    image_file.seek(0, os.SEEK_END)
+    size = image_file.tell() - start
+    image_file.seek(start)
+
     blob = bucket.blob(filename)
-    blob.upload_from_string(image_bytes, content_type="image/png")
-    blob.make_public()
+    blob.upload_from_file(
+        image_file,
+        size=size,
+        content_type="image/png",
+        predefined_acl="publicRead",
+    )
     return blob.public_url
 
+@metrics.timed("storage.exists")
+def blob_exists(filename: str) -> bool:
+    return bucket.blob(filename).exists()
+
+@metrics.timed("storage.upload_variants")
+def upload_variants(blob_name: str, rendered: dict) -> dict:
+    """サムネイル・表示用の派生画像を元画像の隣に置き、{kind: {fmt: url}} を返す"""
+    urls = {}
+    for (kind, fmt), data in rendered.items():
+        blob = bucket.blob(cardVariants.variant_name(blob_name, kind, fmt))
+        blob.upload_from_string(
+            data,
+            content_type=cardVariants.CONTENT_TYPES[fmt],
+            predefined_acl="publicRead",
+        )
+        urls.setdefault(kind, {})[fmt] = blob.public_url
+    return urls
+
 # =====================
-# /save_profile
+# /save_profile（ジョブ投入）
 # =====================
-@app.post("/save_profile")
-def save_profile(profile: saveUserProfile):
-    try:
-        is_true = trivia_trueorfalse(profile.trivia)
+SAVE_PROFILE_STAGES = ("analyze", "generate_image", "upload", "save")
 
-        image_bytes = generate_image(
-            trivia=profile.trivia,
-            steps=35,
-            width=512,
-            height=512
-        )
+def card_blob_name(user_id: str, ver: int, key: str) -> str:
+    """
+    画像の名前は SD の入力（ペイロードのハッシュ key）ごとに変える。
+    別の入力の画像や作り直した画像が同じ名前に上書きされないようにする
+    （公開 URL はキャッシュされるため、上書きすると端末には古い画像が出続ける）
+    """
+    return f"cards/{user_id}_v{ver}_{key[:16]}.png"
 
-        timestamp = int(datetime.datetime.now().timestamp())
-        # filename = f"cards/{profile.nickname}_{timestamp}.png"
-        filename = f"cards/{profile.id}_v{profile.ver}.png"
+def render_card(report, user_id: str, ver: int, prompt_text: str, tier: dict) -> tuple[str, dict | None]:
+    """指定ティアで画像を作ってアップロードし、(URL, 派生画像の URL or None) を返す"""
+    payload = build_sd_payload(
+        prompt_text=prompt_text,
+        steps=tier["steps"],
+        width=tier["width"],
+        height=tier["height"],
+        sampler=tier["sampler"]
+    )
 
-        image_url = upload_image_to_storage(image_bytes, filename)
+    def create(key: str):
+        filename = card_blob_name(user_id, ver, key)
+        start = time.perf_counter()
+        image_file = generate_image(payload)
+        admissionControl.record_latency(time.perf_counter() - start)
+        report("upload")
+        # 派生画像の子プロセスにはファイルのパスだけを渡す（元画像をメモリに読み込んで送らない）
+        with image_file, tempfile.NamedTemporaryFile(suffix=".png", delete=False) as png:
+            shutil.copyfileobj(image_file, png)
+        try:
+            # 派生画像は別プロセスでエンコードし、その間に元画像を送る
+            variants = cardVariants.submit(png.name)
+            with open(png.name, "rb") as f:
+                image_url = upload_image_to_storage(f, filename)
+            with metrics.timer("variants.encode_wait"):
+                rendered = variants.result()
+        finally:
+            os.remove(png.name)
+        return filename, image_url, upload_variants(filename, rendered)
 
-        db.collection("p2hacks2025").add({
-            "nickname": profile.nickname,
-            "birthday": profile.birthday,
-            "birthplace": profile.birthplace,
-            "trivia": profile.trivia,
-            "is_true": is_true,
-            "image_url": image_url,
-            "ver": profile.ver,
-            "id": profile.id,
-            "created_at": datetime.datetime.now()
-        })
+    # 同じペイロードで作った画像があれば使い回す（派生画像は作ったときに記録した URL だけを返す）
+    _, image_url, image_variants = cardCache.get_or_create(payload, create, exists=blob_exists)
+    return image_url, image_variants
 
-        return JSONResponse({
-            "status": "success",
+# 同じ id / ver の再送で使い回すカード画像の項目
+CARD_IMAGE_FIELDS = ("image_url", "image_variants", "sd_prompt", "quality_tier", "needs_rerender")
+
+def save_card(report, profile: saveUserProfile) -> dict:
+    """
+    同じ id / ver の同時の再送は1回にまとめる
+    （プロンプトは Gemini が毎回作り直すので、ペイロードのハッシュだけではまとまらない）
+    """
+    led = []
+
+    def lead():
+        led.append(True)
+        return store_card(report, profile)
+
+    result = cardCache.singleflight(("card", profile.id, profile.ver), lead)
+    if led:
+        return result
+    # 待っていた側は、先に保存された画像で自分のプロフィールを保存する
+    return store_card(report, profile)
+
+def store_card(report, profile: saveUserProfile) -> dict:
+    """ワーカー上でカード生成の各ステージを順に実行する"""
+    report("analyze")
+    existing = store.get_profile(profile.id, profile.ver)
+    if existing is not None and existing.get("image_url"):
+        # 同じ id / ver の再送：画像は作り直さない（作り直し済みならその画像のまま）
+        is_true = trivia_trueorfalse(profile.trivia)
+        fields = {field: existing[field] for field in CARD_IMAGE_FIELDS if field in existing}
+    else:
+        is_true, prompt_text = analyze_trivia(profile.trivia)
+
+        # 混み具合に応じて品質を落とす（落としたものは空き時間に作り直す）
+        tier = admissionControl.choose_tier(jobQueue.pending_count())
+
+        report("generate_image")
+        image_url, image_variants = render_card(report, profile.id, profile.ver, prompt_text, tier)
+        fields = {
             "image_url": image_url,
-            "is_true": is_true,
+            "image_variants": image_variants,
+            "sd_prompt": prompt_text,
+            "quality_tier": tier["name"],
+            "needs_rerender": admissionControl.is_degraded(tier),
+        }
+
+    report("save")
+    store.create_profile({
+        "nickname": profile.nickname,
+        "birthday": profile.birthday,
+        "birthplace": profile.birthplace,
+        "trivia": profile.trivia,
+        "is_true": is_true,
+        "ver": profile.ver,
+        "id": profile.id,
+        "created_at": datetime.datetime.now(),
+        **fields,
+    })
+    # このカードを受信箱に持っている人の次回の /sync に載せる
+    store.touch_encounters(profile.id, profile.ver)
+
+    return {
+        "image_url": fields["image_url"],
+        "image_variants": fields.get("image_variants"),
+        "is_true": is_true,
+        "quality_tier": fields.get("quality_tier"),
+    }
+
+def run_save_profile(report, profile: saveUserProfile) -> dict:
+    """カード生成の結果を購読者（/events・/ws）にも知らせる"""
+    event = {"id": profile.id, "ver": profile.ver}
+    try:
+        result = save_card(report, profile)
+    except Exception as e:
+        eventBus.publish((profile.id, profile.ver), {
+            **event, "type": "card_failed", "error": f"{type(e).__name__}: {e}",
         })
+        raise
+
+    eventBus.publish((profile.id, profile.ver), {**event, "type": "card_ready", **result})
+    return result
+
+# =====================
+# 品質を落としたカードの作り直し（空き時間）
+# =====================
+QUALITY_RERENDER_INTERVAL_SEC = float(os.getenv("QUALITY_RERENDER_INTERVAL_SEC", "60"))
+RERENDER_STAGES = ("generate_image", "upload", "save")
+
+_rerender_stop = threading.Event()
 
+def run_rerender(report, user_id: str, ver: int) -> dict:
+    data = store.get_profile(user_id, ver)
+    tier = admissionControl.FULL_TIER
+
+    report("generate_image")
+    image_url, image_variants = render_card(report, user_id, ver, data["sd_prompt"], tier)
+
+    report("save")
+    store.update_profile(user_id, ver, {
+        "image_url": image_url,
+        "image_variants": image_variants,
+        "quality_tier": tier["name"],
+        "needs_rerender": False,
+    })
+    profileCache.invalidate(user_id, ver)
+    store.touch_encounters(user_id, ver)
+    eventBus.publish((user_id, ver), {
+        "type": "card_updated",
+        "id": user_id,
+        "ver": ver,
+        "image_url": image_url,
+        "image_variants": image_variants,
+        "quality_tier": tier["name"],
+    })
+
+    return {"image_url": image_url}
+
+def _rerender_loop():
+    while not _rerender_stop.wait(QUALITY_RERENDER_INTERVAL_SEC):
+        # ジョブが1件でもあれば新規のカードを優先する
+        if jobQueue.pending_count() > 0:
+            continue
+        try:
+            profiles = store.list_profiles({"needs_rerender": True}, limit=1)
+            if profiles:
+                jobQueue.submit(
+                    run_rerender, profiles[0]["id"], profiles[0]["ver"],
+                    stages=RERENDER_STAGES,
+                )
+        except Exception as e:
+            print(f"rerender scan failed: {e}")
+
+@app.post("/save_profile")
+async def save_profile(profile: saveUserProfile):
+    try:
+        job_id = jobQueue.submit(
+            run_save_profile, profile, stages=SAVE_PROFILE_STAGES
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+    return JSONResponse(
+        status_code=202,
+        headers={"Location": f"/jobs/{job_id}"},
+        content={
+            "status": "accepted",
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+        }
+    )
+
+# =====================
+# /jobs/{job_id}（進捗確認）
+# =====================
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobQueue.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Job not found"
+        )
+
+    result = job["result"] or {}
+    return JSONResponse({
+        "status": "success",
+        "job_id": job_id,
+        "state": job["state"],
+        "stage": job["stage"],
+        "progress": jobQueue.progress(job),
+        "image_url": result.get("image_url"),
+        "is_true": result.get("is_true"),
+        "quality_tier": result.get("quality_tier"),
+        "error": job["error"],
+        "timings_ms": {
+            stage: round(elapsed * 1000, 1)
+            for stage, elapsed in job["timings"].items()
+        },
+    })
+
 # =====================
 # /get_user_profile
 # =====================
 @app.post("/get_user_profile")
-def get_user_profile(profile: getUserProfile):
+async def get_user_profile(profile: getUserProfile, request: Request):
     try:
-        # Firestore クエリ
-        query = (
-            db.collection("p2hacks2025")
-            .where("id", "==", profile.id)
-            .where("ver", "==", profile.ver)
-            .limit(1)
-            .stream()
-        )
+        data = await load_profile(profile.id, profile.ver)
 
-        docs = list(query)
-
-        if not docs:
+        if data is None:
             raise HTTPException(
                 status_code=404,
                 detail="Profile not found"
             )
 
-        data = docs[0].to_dict()
-
-        return JSONResponse({
+        return etag_response(request, {
             "status": "success",
             "data": {
                 "nickname": data.get("nickname"),
@@ -229,8 +692,10 @@ def get_user_profile(profile: getUserProfile):
                 "trivia": data.get("trivia"),
                 "is_true": data.get("is_true"),
                 "image_url": data.get("image_url"),
+                "image_variants": data.get("image_variants"),
                 "id": data.get("id"),
                 "ver": data.get("ver"),
+                "hey": data.get("hey"),
             }
         })
 
@@ -240,69 +705,44 @@ def get_user_profile(profile: getUserProfile):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/get_otheruser_profiles")
-def get_user_profiles(req: getotherUserProfiles):
+async def get_user_profiles(req: getotherUserProfiles, request: Request):
     try:
-        results = []
+        profiles = await load_profiles(list(req.targets.items()))
 
+        # ETag が安定するようリクエストの順に並べる
+        results = []
+        not_found = []
         for user_id, ver in req.targets.items():
-            docs = (
-                db.collection("p2hacks2025")
-                .where("id", "==", user_id)
-                .where("ver", "==", ver)
-                .stream()
-            )
+            profile = profiles.get((user_id, ver))
+            if profile is None:
+                not_found.append({"id": user_id, "ver": ver})
+            else:
+                results.append(profile)
 
-            for doc in docs:
-                data = doc.to_dict()
-                data["doc_id"] = doc.id
-                results.append(data)
-
-        # datetime → JSON 変換
-        return JSONResponse(
-            status_code=200,
-            content=jsonable_encoder(results)
-        )
+        return etag_response(request, {
+            "status": "success",
+            "data": results,
+            "not_found": not_found,
+        })
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
-from google.cloud.firestore import Increment
-
 @app.post("/heyplus")
-def hey_plus(req: heycount):
+async def hey_plus(req: heycount):
     try:
-        # 対象ドキュメント取得
-        docs = (
-            db.collection("p2hacks2025")
-            .where("id", "==", req.id)
-            .where("ver", "==", req.ver)
-            .limit(1)
-            .stream()
-        )
-
-        docs = list(docs)
-
-        if not docs:
+        # 存在確認と hey の読み込み（キャッシュにあれば保存先は読まない）
+        profile = await load_profile(req.id, req.ver)
+        if profile is None:
             raise HTTPException(
                 status_code=404,
                 detail="Profile not found"
             )
 
-        doc = docs[0]
-        doc_ref = doc.reference
-        data = doc.to_dict()
-
-        # 現在の hey（なければ 0）
-        current_hey = data.get("hey", 0)
-
-        # 加算
-        new_hey = current_hey + req.pushedhey
-
-        # Firestore 更新
-        doc_ref.update({
-            "hey": new_hey,
-            "updated_at": datetime.datetime.now()
-        })
+        # バッファに積むだけ（hey はキャッシュ済みなのでここでは待たない）
+        new_hey = heyCounter.add(req.id, req.ver, req.pushedhey)
+        eventBus.publish_hey((req.id, req.ver), new_hey)
+        leaderboard.record(profile, new_hey)
 
         return JSONResponse(
             status_code=200,
@@ -320,9 +760,377 @@ def hey_plus(req: heycount):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# =====================
+# /heyplus/batch（まとめて加算）
+# =====================
+@app.post("/heyplus/batch")
+async def hey_plus_batch(req: heycountBatch):
+    try:
+        # 同じ (id, ver) はまとめる（最初に出てきた順を保つ）
+        deltas = {}
+        for item in req.items:
+            key = (item.id, item.ver)
+            deltas[key] = deltas.get(key, 0) + item.pushedhey
+
+        # 存在確認と hey の読み込みをまとめて1回で済ませる
+        profiles = await load_profiles(list(deltas))
+        found = {key: delta for key, delta in deltas.items() if key in profiles}
+
+        totals = heyCounter.add_many(found)
+        for key, hey in totals.items():
+            eventBus.publish_hey(key, hey)
+            leaderboard.record(profiles[key], hey)
+        # 保存先へ最大500件ずつまとめて書き込む
+        await asyncio.to_thread(heyCounter.flush)
+
+        return JSONResponse(
+            status_code=200,
+            content={
+                "status": "success",
+                "results": [
+                    {"id": user_id, "ver": ver, "pushedhey": delta, "hey": totals[(user_id, ver)]}
+                    for (user_id, ver), delta in found.items()
+                ],
+                "not_found": [
+                    {"id": user_id, "ver": ver}
+                    for user_id, ver in deltas
+                    if (user_id, ver) not in found
+                ],
+            }
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# =====================
+# /encounters（すれ違いの記録）
+# =====================
+MAX_ENCOUNTERS_PER_REQUEST = int(os.getenv("MAX_ENCOUNTERS_PER_REQUEST", "500"))
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "100"))
+
+@app.post("/encounters")
+async def record_encounters(req: encounterBatch):
+    if len(req.encounters) > MAX_ENCOUNTERS_PER_REQUEST:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many encounters (max {MAX_ENCOUNTERS_PER_REQUEST})"
+        )
+
+    try:
+        # 同じ相手は最後にすれ違った日時にまとめる（自分自身は除く）
+        latest = {}
+        for item in req.encounters:
+            if item.peer_id == req.observer:
+                continue
+            key = (item.peer_id, item.peer_ver)
+            latest[key] = max(latest.get(key, 0), item.timestamp)
+
+        cursor = await store.aadd_encounters(req.observer, latest) if latest else None
+
+        return JSONResponse({
+            "status": "success",
+            "recorded": len(latest),
+            "cursor": str(cursor) if cursor else None,
+        })
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# =====================
+# /sync（前回から増えた・変わったカードだけ返す）
+# =====================
+@app.get("/sync")
+async def sync_inbox(
+    user_id: str,
+    since: str = "0",
+    limit: int = Query(default=SYNC_PAGE_SIZE, ge=1, le=500),
+):
+    try:
+        since_seq = int(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    try:
+        entries = await store.aread_inbox(user_id, since_seq, limit)
+        profiles = await load_profiles([(e["peer_id"], e["peer_ver"]) for e in entries])
+
+        cards = []
+        pending = []
+        for entry in entries:
+            profile = profiles.get((entry["peer_id"], entry["peer_ver"]))
+            if profile is None:
+                # 相手のカードがまだ保存されていない（保存されたら再び載る）
+                pending.append({"id": entry["peer_id"], "ver": entry["peer_ver"]})
+                continue
+            cards.append({
+                **profile,
+                "seen_at": entry["seen_at"],
+                "encounter_count": entry["count"],
+            })
+
+        cursor = entries[-1]["seq"] if entries else since_seq
+        return JSONResponse(jsonable_encoder({
+            "status": "success",
+            "data": cards,
+            "pending": pending,
+            "cursor": str(cursor),
+            "has_more": len(entries) == limit,
+        }))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# =====================
+# /leaderboard（へえランキング）
+# =====================
+LEADERBOARD_KINDS = ("global", "birthplace", "birthday")
+
+@app.get("/leaderboard")
+async def get_leaderboard(
+    request: Request,
+    kind: str = "global",
+    value: str | None = None,
+    limit: int = Query(default=leaderboard.LEADERBOARD_SIZE, ge=1, le=leaderboard.LEADERBOARD_SIZE),
+):
+    """kind=global / birthplace（value=出身地） / birthday（value=MM/DD、"1月15日" なども可）"""
+    if kind not in LEADERBOARD_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {LEADERBOARD_KINDS}")
+    if kind != "global" and not value:
+        raise HTTPException(status_code=400, detail="value is required")
+
+    if kind == "birthday":
+        name = leaderboard.birthday_board(value)
+        if name is None:
+            raise HTTPException(status_code=400, detail="value must be a date (MM/DD)")
+    elif kind == "birthplace":
+        name = leaderboard.birthplace_board(value)
+        if name is None:
+            raise HTTPException(status_code=400, detail="value must be a prefecture")
+    else:
+        name = kind
+    return etag_response(request, jsonable_encoder({
+        "status": "success",
+        "board": name,
+        "data": leaderboard.top(name, limit),
+    }))
+
+# =====================
+# /reference（誕生日・都道府県の参照データ）
+# =====================
+REFERENCE_BUNDLE_PATH = "/reference/bundles"
+# 中身が変われば URL（ハッシュ）が変わるので、永続的にキャッシュさせてよい
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REFERENCE_LOOKUP_CACHE = "public, max-age=300"
+
+@app.get("/reference/manifest")
+async def reference_manifest(request: Request):
+    """バンドルごとのハッシュと URL（ハッシュが変わったものだけ取り直せばよい）"""
+    return etag_response(request, {
+        "status": "success",
+        "bundles": referenceData.manifest(REFERENCE_BUNDLE_PATH),
+    })
+
+@app.get(REFERENCE_BUNDLE_PATH + "/{name}.{content_hash}.json")
+async def reference_bundle(name: str, content_hash: str, request: Request):
+    bundle = referenceData.get(name)
+    if bundle is None or bundle["hash"] != content_hash:
+        # 古いハッシュ：マニフェストから取り直してもらう
+        raise HTTPException(status_code=404, detail="Bundle not found")
+
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE,
+        "ETag": f'"{bundle["hash"]}"',
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    encoding = referenceData.choose_encoding(request.headers.get("accept-encoding", ""), bundle)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=bundle[encoding], media_type="application/json", headers=headers)
+
+@app.get("/reference/day")
+async def reference_day(date: str):
+    """date=MM/DD（1/1・01-01・0101 も可）"""
+    result = referenceData.day(date)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Date not found")
+    return JSONResponse(
+        {"status": "success", "data": result},
+        headers={"Cache-Control": REFERENCE_LOOKUP_CACHE},
+    )
+
+@app.get("/reference/prefecture/{name}")
+async def reference_prefecture(name: str):
+    result = referenceData.prefecture(name)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Prefecture not found")
+    return JSONResponse(
+        {"status": "success", "data": result},
+        headers={"Cache-Control": REFERENCE_LOOKUP_CACHE},
+    )
+
+# =====================
+# /events（SSE）・/ws（WebSocket）：カード完成と hey の通知
+# =====================
+EVENT_HEARTBEAT_SEC = float(os.getenv("EVENT_HEARTBEAT_SEC", "15"))
+
+def parse_topics(items) -> list:
+    """["id:ver", ...] または [{"id":..., "ver":...}, ...] → [(id, ver)]"""
+    keys = []
+    for item in items or ():
+        if isinstance(item, dict):
+            keys.append((str(item["id"]), int(item["ver"])))
+        else:
+            user_id, _, ver = str(item).rpartition(":")
+            keys.append((user_id, int(ver)))
+    if len(keys) > eventBus.MAX_EVENT_TOPICS:
+        raise ValueError(f"Too many topics (max {eventBus.MAX_EVENT_TOPICS})")
+    return keys
+
+@app.get("/events")
+async def events(request: Request, topics: str):
+    """topics=id:ver,id:ver（自分のカードとコレクションのカード）"""
+    try:
+        keys = parse_topics(t for t in topics.split(",") if t)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    subscription = eventBus.subscribe(keys)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(EVENT_HEARTBEAT_SEC)
+                if event is None:
+                    # 途中のプロキシに切られないように
+                    yield ": ping\n\n"
+                    continue
+                data = json.dumps(jsonable_encoder(event), ensure_ascii=False)
+                yield f"event: {event['type']}\ndata: {data}\n\n"
+        finally:
+            eventBus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/ws")
+async def events_ws(websocket: WebSocket):
+    """{"subscribe": [...], "unsubscribe": [...]} で購読するカードを増減できる"""
+    await websocket.accept()
+    subscription = eventBus.subscribe()
+
+    async def receive():
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except WebSocketDisconnect:
+                return
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "message is not valid JSON"})
+                continue
+            if not isinstance(message, dict):
+                await websocket.send_json({"type": "error", "detail": "message must be a JSON object"})
+                continue
+            try:
+                eventBus.update(
+                    subscription,
+                    add=parse_topics(message.get("subscribe")),
+                    remove=parse_topics(message.get("unsubscribe")),
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            # 切断（受信側の終了）にもすぐ気づけるよう、次のイベントと一緒に待つ
+            getter = asyncio.create_task(subscription.get(EVENT_HEARTBEAT_SEC))
+            await asyncio.wait({receiver, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            await websocket.send_json(jsonable_encoder(getter.result() or {"type": "ping"}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # 受信側が例外で止まっていたらログに残す（取り出さないと警告だけになる）
+        if receiver.done() and not receiver.cancelled() and receiver.exception() is not None:
+            print(f"websocket receiver failed: {receiver.exception()!r}")
+        receiver.cancel()
+        eventBus.unsubscribe(subscription)
+
+# =====================
+# 統計
+# =====================
+@app.get("/sd/stats")
+async def sd_stats():
+    return {
+        **sdClient.stats(),
+        "admission": admissionControl.stats(),
+        "queue_depth": jobQueue.pending_count(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    metrics.gauge_set("job_queue_depth", jobQueue.pending_count())
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/leaderboard/stats")
+async def leaderboard_stats():
+    return leaderboard.stats()
+
+@app.get("/events/stats")
+async def events_stats():
+    return eventBus.stats()
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return {
+        **llmGateway.stats(),
+        "verdict_cache": verdictCache.stats(),
+        "evidence_search": evidenceSearch.stats(),
+    }
+
+# =====================
+# 起動・終了処理
+# =====================
+@app.on_event("startup")
+def startup_counters():
+    heyCounter.start(store)
+    # 前回書き出したランキングを読み込む
+    leaderboard.start(store)
+    threading.Thread(target=_rerender_loop, name="rerender", daemon=True).start()
+
+@app.on_event("startup")
+def startup_reference_data():
+    referenceData.load()
+
+@app.on_event("startup")
+async def startup_events():
+    eventBus.start()
+
+@app.on_event("shutdown")
+async def shutdown_events():
+    await eventBus.stop()
+
+@app.on_event("shutdown")
+def shutdown_jobs():
+    _rerender_stop.set()
+    jobQueue.shutdown()
+    cardVariants.shutdown()
+    # バッファに残った hey を書き込む
+    heyCounter.stop()
+    leaderboard.stop()
+
 # =====================
 # ヘルスチェック
 # =====================
 @app.get("/")
-def root():
+async def root():
     return {"message": "Profile + Trivia + Card API running"}
@@ -3,8 +3,12 @@ from flask_cors import CORS
 import json
 import os
 from datetime import datetime
-from dotenv import load_dotenv
-import google.generativeai as genai
+import sys
+from pathlib import Path
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import llmGateway
 
 app = Flask(__name__)
 CORS(app)  # CORSを有効化
@@ -17,16 +21,7 @@ PROFILE_FILE = os.path.join(DATA_DIR, "profile.json")
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
-# .envを読み込む
-load_dotenv(override=True)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise RuntimeError("GEMINI_API_KEY is not set")
-
-genai.configure(api_key=GEMINI_API_KEY)
-
 def trivia_trueorfalse(trivia: str):
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
     prompt = f"""
 あなたはファクトチェッカーです。
 以下の文が事実として正しいかどうかを判断してください。
@@ -40,8 +35,7 @@ def trivia_trueorfalse(trivia: str):
 【検証対象】
 {trivia}
 """
-    response = model.generate_content(prompt)
-    text = response.text.strip()
+    text = llmGateway.generate_text(prompt)
 
     if text == "True":
         return True
@@ -1,15 +1,19 @@
-import requests, base64
+import sys
+from pathlib import Path
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+# SD の接続先は sdClient（SD_BACKENDS）で設定する
+import sdClient
+import initImageCache
 
 def generate_img2img(
     prompt,
     input_image_path="test.png"
     # 本当はface.pngみたいなの
 ):
-    url = "https://17413e299b41.ngrok-free.app/sdapi/v1/img2img"
-
-    # 入力画像をbase64化
-    with open(input_image_path, "rb") as f:
-        init_img = base64.b64encode(f.read()).decode("utf-8")
+    # 入力画像をbase64化（同じ画像なら読み直さない）
+    init_img = initImageCache.encode_file(input_image_path)
 
     payload = {
         "init_images": [init_img],
@@ -25,17 +29,10 @@ def generate_img2img(
         "height": 512
     }
 
-    r = requests.post(
-        url,
-        json=payload,
-        auth=("user", "password")
-    )
-    r.raise_for_status()
-
-    img = r.json()["images"][0]
+    img = sdClient.img2img(payload)
 
     with open("img2img.png", "wb") as f:
-        f.write(base64.b64decode(img))
+        f.write(img)
 
     print("img2img.png generated")
 
@@ -1,37 +1,319 @@
+"""
+プロフィールの JSON / NDJSON を Firestore にまとめて書き込む。
+
+入力は1件ずつ読みながら BulkWriter で並列に書き込む（全体をメモリに載せない）。
+ドキュメントIDは {id}_v{ver} なので、同じファイルを何度流しても結果は同じになる。
+書き込めなかった行は理由と一緒に dead-letter の NDJSON に残す。
+
+  python back/firebase/firebasewrite.py data.json
+  python back/firebase/firebasewrite.py profiles.ndjson --max-ops 2000 --dead-letter rejected.ndjson
+"""
+import argparse
 import json
+import sys
+import threading
+import time
+from pathlib import Path
+
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
+
+from profileStore import PROFILE_COLLECTION, profile_doc_id  # noqa: E402
+
 # =========================
 # Firebase 初期化
 # =========================
 SERVICE_ACCOUNT_PATH = "p2hacks.json"  # JSONの名前を変えてもOK
-cred = credentials.Certificate(SERVICE_ACCOUNT_PATH)
-firebase_admin.initialize_app(cred)
 
-db = firestore.client()
+# 1回に読むバイト数（JSON 配列を少しずつ読む）
+READ_CHUNK_SIZE = 1 << 16
+# JSON 配列の1要素の上限（これより大きい要素は dead-letter に回して読み飛ばす）
+MAX_ELEMENT_CHARS = 1 << 20
+
 
 # =========================
-# JSON ファイル読み込み
+# 入力（JSON 配列 / NDJSON を1件ずつ）
 # =========================
-JSON_DATA_PATH = "data.json"  # 書き込みたいJSONファイル
+def iter_ndjson(f):
+    """(行番号, データ or None, エラー, 元の文字列)"""
+    for number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line), None, line
+        except json.JSONDecodeError as e:
+            yield number, None, f"invalid json: {e}", line
+
+
+def _scan_element(text: str, start: int, state: list) -> int | None:
+    """
+    text[start:] を読み進め、要素の終わり（深さ0の "," か、配列を閉じる "]"）の位置を返す。
+    見つからなければ None を返し、途中の状態 [開いている括弧, 文字列の中か, エスケープ直後か] を state に残す。
+    対応しない閉じ括弧は、対応する開き括弧までまとめて閉じたものとみなす。
+    """
+    opened, in_string, escape = state
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "[{":
+            opened += ch
+        elif ch in "]}":
+            if not opened:
+                return i
+            match = "[" if ch == "]" else "{"
+            cut = opened.rfind(match)
+            opened = opened[:cut] if cut >= 0 else opened[:-1]
+        elif ch == "," and not opened:
+            return i
+    state[:] = [opened, in_string, escape]
+    return None
+
+
+def iter_json_array(f):
+    """
+    [{...}, {...}] を先頭から1要素ずつ読む。(要素番号, データ or None, エラー, 元の文字列)
+    壊れた要素は飛ばして続きを読み、バッファは MAX_ELEMENT_CHARS 程度までしか伸ばさない。
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip(chars: str):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip(" \t\r\n")
+    if buffer[pos:pos + 1] != "[":
+        raise ValueError("JSON input must be an array of objects")
+    pos += 1
+
+    number = 0
+    while True:
+        skip(" \t\r\n,")
+        if pos >= len(buffer):
+            raise ValueError("unexpected end of JSON array")
+        if buffer[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            state = ["", False, False]
+            end = _scan_element(buffer, pos, state)
+            if end is None and not eof and len(buffer) - pos < MAX_ELEMENT_CHARS:
+                # 要素が途中で切れているので読み足す
+                fill()
+                continue
+
+            number += 1
+            if end is not None:
+                # 要素は最後まで読めているのに壊れている：その要素だけ飛ばす
+                yield number, None, f"invalid json: {e.msg}", buffer[pos:end].strip()
+                pos = end
+                continue
+
+            # 大きすぎる・途中でファイルが終わった要素：終わりまで読み捨てる
+            head = buffer[pos:pos + 200]
+            reason = "unexpected end of file" if eof else f"element larger than {MAX_ELEMENT_CHARS} chars"
+            yield number, None, reason, head
+            scanned = len(buffer)
+            while end is None and not eof:
+                pos = scanned
+                fill()
+                end = _scan_element(buffer, 0, state)
+                scanned = len(buffer)
+            if end is None:
+                return
+            pos = end
+            continue
+
+        if end == len(buffer) and not eof:
+            # 数値がバッファの終わりで切れているかもしれない（12345 → 12）ので読み足してから読み直す
+            fill()
+            continue
+
+        number += 1
+        pos = end
+        yield number, value, None, None
+
+
+def iter_rows(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            yield from iter_ndjson(f)
+            return
+        # 拡張子で分からなければ先頭の文字で判断する
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        f.seek(0)
+        yield from (iter_json_array(f) if head == "[" else iter_ndjson(f))
+
+
+def validate(row) -> str | None:
+    """取り込めない理由（問題なければ None）"""
+    if not isinstance(row, dict):
+        return "row is not an object"
+    if not isinstance(row.get("id"), str) or not row["id"]:
+        return "missing id"
+    if isinstance(row.get("ver"), bool) or not isinstance(row.get("ver"), int):
+        return "missing or non-integer ver"
+    return None
 
-with open(JSON_DATA_PATH, "r", encoding="utf-8") as f:
-    data_list = json.load(f)  # JSON はリスト形式が推奨
-    # 例: [{"name": "Taro", "age": 25}, {"name": "Hanako", "age": 30}]
 
 # =========================
 # Firestore に書き込み
 # =========================
-def write_to_firestore(collection_name: str, data_list: list):
-    collection_ref = db.collection(collection_name)
-    for data in data_list:
-        # ドキュメントIDを自動生成して追加
-        doc_ref = collection_ref.add(data)
-        print(f"Added document with ID: {doc_ref[1].id}")
+class Importer:
+    """BulkWriter の結果を集計し、失敗した行を dead-letter に書く"""
+
+    def __init__(self, db, collection_name: str, dead_letter_path: str,
+                 max_ops: int, max_attempts: int):
+        from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+
+        self.collection_ref = db.collection(collection_name)
+        self.max_attempts = max_attempts
+        self.writer = db.bulk_writer(options=BulkWriterOptions(
+            initial_ops_per_second=min(500, max_ops),
+            max_ops_per_second=max_ops,
+            mode=SendMode.parallel,
+        ))
+        self.writer.on_write_result(self._on_result)
+        self.writer.on_write_error(self._on_error)
+
+        self._lock = threading.Lock()
+        # doc_id → (行番号, データ)。書き込みが終わったものは消す
+        self._pending = {}
+        self._dead_letter = open(dead_letter_path, "a", encoding="utf-8")
+        self.stats = {"read": 0, "written": 0, "rejected": 0, "failed": 0}
+
+    def _dead(self, number: int, reason: str, key: str, row=None, raw: str | None = None):
+        record = {"line": number, "reason": reason}
+        if raw is not None:
+            record["raw"] = raw
+        else:
+            record["row"] = row
+        with self._lock:
+            self._dead_letter.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self.stats[key] += 1
+
+    def _on_result(self, reference, result, bulk_writer):
+        with self._lock:
+            self._pending.pop(reference.id, None)
+            self.stats["written"] += 1
+
+    def _on_error(self, error, bulk_writer) -> bool:
+        # 一時的なエラーは BulkWriter が間隔を空けて再試行する
+        if error.attempts < self.max_attempts:
+            return True
+        with self._lock:
+            number, row = self._pending.pop(error.operation.reference.id, (None, None))
+        self._dead(number, f"write failed ({error.code}): {error.message}", "failed", row=row)
+        return False
+
+    def add(self, number: int, row, error: str | None = None, raw: str | None = None):
+        with self._lock:
+            self.stats["read"] += 1
+        reason = error or validate(row)
+        if reason is not None:
+            self._dead(number, reason, "rejected", row=row, raw=raw)
+            return
+
+        doc_id = profile_doc_id(row["id"], row["ver"])
+        with self._lock:
+            self._pending[doc_id] = (number, row)
+        self.writer.set(self.collection_ref.document(doc_id), row, merge=True)
+
+    def flush(self):
+        self.writer.flush()
+        self._dead_letter.flush()
+
+    def close(self):
+        self.writer.close()
+        self._dead_letter.close()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+def write_to_firestore(db, collection_name: str, path: str, dead_letter_path: str,
+                       max_ops: int = 2000, max_attempts: int = 5,
+                       flush_every: int = 10000, progress_sec: float = 5.0) -> dict:
+    """path の行を collection_name に書き込み、集計を返す"""
+    importer = Importer(db, collection_name, dead_letter_path, max_ops, max_attempts)
+    start = time.monotonic()
+    last_report = start
+
+    def report(final: bool = False):
+        stats = importer.snapshot()
+        elapsed = time.monotonic() - start
+        rate = stats["written"] / elapsed if elapsed else 0.0
+        label = "done" if final else "progress"
+        print(
+            f"{label}: read={stats['read']} written={stats['written']} "
+            f"rejected={stats['rejected']} failed={stats['failed']} ({rate:.0f} docs/s)"
+        )
+
+    try:
+        for count, (number, row, error, raw) in enumerate(iter_rows(path), start=1):
+            importer.add(number, row, error, raw)
+            # 書き込み待ちが溜まりすぎないよう、一定件数ごとに送り切る
+            if count % flush_every == 0:
+                importer.flush()
+            if time.monotonic() - last_report >= progress_sec:
+                last_report = time.monotonic()
+                report()
+        importer.flush()
+    finally:
+        importer.close()
+
+    report(final=True)
+    return importer.snapshot()
+
 
 # =========================
 # 実行
 # =========================
 if __name__ == "__main__":
-    write_to_firestore("users", data_list)
+    parser = argparse.ArgumentParser(description="プロフィールの JSON / NDJSON を Firestore に一括で書き込む")
+    parser.add_argument("path", nargs="?", default="data.json", help="JSON 配列か NDJSON（.ndjson / .jsonl）")
+    parser.add_argument("--collection", default=PROFILE_COLLECTION)
+    parser.add_argument("--dead-letter", default="dead_letter.ndjson", help="書き込めなかった行の保存先")
+    parser.add_argument("--max-ops", type=int, default=2000, help="1秒あたりの書き込み上限")
+    parser.add_argument("--max-attempts", type=int, default=5, help="1件あたりの試行回数")
+    parser.add_argument("--flush-every", type=int, default=10000, help="この件数ごとに書き込み待ちを送り切る")
+    args = parser.parse_args()
+
+    cred = credentials.Certificate(SERVICE_ACCOUNT_PATH)
+    firebase_admin.initialize_app(cred)
+
+    write_to_firestore(
+        firestore.client(), args.collection, args.path, args.dead_letter,
+        max_ops=args.max_ops, max_attempts=args.max_attempts, flush_every=args.flush_every,
+    )
@@ -0,0 +1,92 @@
+import argparse
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+# =========================
+# Firebase 初期化
+# =========================
+SERVICE_ACCOUNT_PATH = "p2hacks.json"  # 必要に応じて名前を変更
+COLLECTION_NAME = "p2hacks2025"
+
+# バッチ1回あたりの操作数の上限
+MAX_BATCH_OPS = 500
+
+
+def profile_doc_id(user_id: str, ver: int) -> str:
+    return f"{user_id}_v{ver}"
+
+
+# =========================
+# 移行
+# =========================
+def migrate(db, dry_run: bool = False):
+    """
+    自動IDで add されたドキュメントを {id}_v{ver} のIDに付け替える。
+    同じ (id, ver) が複数あるときは最新のものを残し、hey は合算する。
+    """
+    collection_ref = db.collection(COLLECTION_NAME)
+
+    # (id, ver) ごとに移行対象を集める
+    groups = {}
+    for doc in collection_ref.stream():
+        data = doc.to_dict()
+        if "id" not in data or "ver" not in data:
+            print(f"skip (no id/ver): {doc.id}")
+            continue
+        key = profile_doc_id(data["id"], data["ver"])
+        groups.setdefault(key, []).append(doc)
+
+    batch = db.batch()
+    pending = 0
+    migrated = 0
+
+    for key, docs in groups.items():
+        legacy = [doc for doc in docs if doc.id != key]
+        if not legacy:
+            continue
+
+        # created_at がないものを先頭に並べる
+        docs.sort(key=lambda d: (
+            d.to_dict().get("created_at") is not None,
+            d.to_dict().get("created_at"),
+        ))
+        merged = dict(docs[-1].to_dict())
+        merged["hey"] = sum(doc.to_dict().get("hey", 0) or 0 for doc in docs)
+
+        print(f"{[doc.id for doc in legacy]} -> {key}")
+        if dry_run:
+            continue
+
+        # set 1回 + delete の操作数
+        ops = 1 + len(legacy)
+        if pending + ops > MAX_BATCH_OPS:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+        batch.set(collection_ref.document(key), merged)
+        for doc in legacy:
+            batch.delete(doc.reference)
+        pending += ops
+        migrated += 1
+
+    if pending:
+        batch.commit()
+
+    print(f"migrated: {migrated}")
+    if not dry_run:
+        print("all documents use {id}_v{ver} now; set LEGACY_DOC_LOOKUP=0 for the API server")
+
+
+# =========================
+# 実行
+# =========================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="p2hacks2025 のドキュメントIDを {id}_v{ver} に移行")
+    parser.add_argument("--dry-run", action="store_true", help="書き込まずに対象だけ表示する")
+    args = parser.parse_args()
+
+    cred = credentials.Certificate(SERVICE_ACCOUNT_PATH)
+    firebase_admin.initialize_app(cred)
+
+    migrate(firestore.client(), dry_run=args.dry_run)
@@ -1,21 +1,15 @@
-import os
-from dotenv import load_dotenv
-import google.generativeai as genai
 import requests, base64
+import sys
+from pathlib import Path
 
-def henerateImagefromtrivia(trivia):
-    load_dotenv(override=True)
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import llmGateway
 
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
-    
+def henerateImagefromtrivia(trivia):
     url = "https://saliently-multiciliated-jacqui.ngrok-free.dev/sdapi/v1/txt2img"
 
-    genai.configure(api_key=api_key)
-
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
-    response = model.generate_content(
+    response = llmGateway.generate(
     trivia + "\n以下のルールに従ってください：\n"
     "・出力は1行のテキストのみ\n"
     "・余計な文章や返事は一切不要\n"
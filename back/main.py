@@ -1,15 +1,16 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.responses import Response
 from pydantic import BaseModel
 import os
-import base64
-import requests
+import sys
+from pathlib import Path
 
-# =====================
-# SD API URL
-# =====================
-TXT2IMG_API_URL = "http://127.0.0.1:7860/sdapi/v1/txt2img"
-IMG2IMG_API_URL = "http://127.0.0.1:7860/sdapi/v1/img2img"
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import envConfig  # noqa: F401
+# SD の接続先は sdClient（SD_BACKENDS）で設定する
+import sdClient
+import initImageCache
 
 app = FastAPI(title="Trivia → Image API")
 
@@ -60,10 +61,7 @@ def generate_image(req: GenerateRequest):
     }
 
     try:
-        r = requests.post(TXT2IMG_API_URL, json=payload, timeout=180)
-        r.raise_for_status()
-        img_base64 = r.json()["images"][0]
-        img_bytes = base64.b64decode(img_base64)
+        img_bytes = sdClient.txt2img(payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image generation failed: {e}")
 
@@ -72,35 +70,57 @@ def generate_image(req: GenerateRequest):
 # =====================
 # img2img
 # =====================
-@app.post("/generate-img2img")
-def generate_img2img(req: Img2ImgRequest):
-    if not os.path.exists(req.input_image_path):
-        raise HTTPException(status_code=400, detail="Input image not found")
-
-    # 入力画像をbase64化
-    with open(req.input_image_path, "rb") as f:
-        init_img = base64.b64encode(f.read()).decode("utf-8")
+IMG2IMG_NEGATIVE_PROMPT = (
+    "low quality, worst quality, blurry, grainy, pixelated, jpeg artifacts, "
+    "bad anatomy, extra limbs, missing limbs, wrong hands, malformed face, "
+    "text, logo, watermark, signature, username, nsfw, nudity, gore, violence"
+)
 
+def run_img2img(init_img: str, prompt: str, steps: int, width: int, height: int,
+                denoising_strength: float) -> Response:
     payload = {
         "init_images": [init_img],
-        "prompt": req.prompt,
-        "negative_prompt": (
-            "low quality, worst quality, blurry, grainy, pixelated, jpeg artifacts, "
-            "bad anatomy, extra limbs, missing limbs, wrong hands, malformed face, "
-            "text, logo, watermark, signature, username, nsfw, nudity, gore, violence"
-        ),
-        "denoising_strength": req.denoising_strength,
-        "steps": req.steps,
-        "width": req.width,
-        "height": req.height
+        "prompt": prompt,
+        "negative_prompt": IMG2IMG_NEGATIVE_PROMPT,
+        "denoising_strength": denoising_strength,
+        "steps": steps,
+        "width": width,
+        "height": height
     }
 
     try:
-        r = requests.post(IMG2IMG_API_URL, json=payload, timeout=180)
-        r.raise_for_status()
-        img_base64 = r.json()["images"][0]
-        img_bytes = base64.b64decode(img_base64)
+        img_bytes = sdClient.img2img(payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Img2Img generation failed: {e}")
 
     return Response(content=img_bytes, media_type="image/png")
+
+@app.post("/generate-img2img")
+def generate_img2img(req: Img2ImgRequest):
+    if not os.path.exists(req.input_image_path):
+        raise HTTPException(status_code=400, detail="Input image not found")
+
+    # 入力画像をbase64化（パス・更新時刻が同じならキャッシュを使う）
+    init_img = initImageCache.encode_file(req.input_image_path)
+
+    return run_img2img(
+        init_img, req.prompt, req.steps, req.width, req.height, req.denoising_strength
+    )
+
+# =====================
+# img2img（画像をアップロード）
+# =====================
+@app.post("/generate-img2img/upload")
+def generate_img2img_upload(
+    image: UploadFile = File(...),
+    prompt: str = Form(...),
+    steps: int = Form(35),
+    width: int = Form(512),
+    height: int = Form(512),
+    denoising_strength: float = Form(0.55),
+):
+    # 少しずつディスクに書き、同じ内容の画像は base64 化を省く
+    path, digest = initImageCache.save_upload(image.file)
+    init_img = initImageCache.encode_hashed_file(path, digest)
+
+    return run_img2img(init_img, prompt, steps, width, height, denoising_strength)
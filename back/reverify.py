@@ -0,0 +1,304 @@
+"""
+保存済みプロフィールの is_true を、今のプロンプト・モデルで判定し直す。
+
+コレクションを doc_id 順に読み、複数のトリビアを1回の Gemini 呼び出しにまとめて判定する。
+ページごとに変わったものだけをまとめて書き込み、進捗をチェックポイントに残すので、
+中断しても同じコマンドで続きから再開できる。
+動いている API サーバーには、プロフィールのキャッシュ期限（PROFILE_CACHE_TTL_SEC）が切れた時点で反映される。
+
+  python back/reverify.py --dry-run
+  python back/reverify.py --batch-size 25 --concurrency 4 --rpm 60
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import envConfig  # noqa: E402,F401
+import google.generativeai as genai  # noqa: E402
+
+import databaseConnect  # noqa: E402
+import llmGateway  # noqa: E402
+import verdictCache  # noqa: E402
+
+REVERIFY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "results": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "index": {"type": "INTEGER", "description": "検証対象の番号"},
+                    "verdict": {
+                        "type": "STRING",
+                        "description": "True / False / Unknown のいずれか",
+                    },
+                },
+                "required": ["index", "verdict"],
+            },
+        },
+    },
+    "required": ["results"],
+}
+
+VERDICTS = {"True": True, "False": False, "Unknown": None}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="保存済みトリビアの真偽を判定し直す")
+    parser.add_argument("--batch-size", type=int, default=25, help="1回の Gemini 呼び出しで判定する件数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に投げる呼び出し数")
+    parser.add_argument("--rpm", type=float, default=60, help="1分あたりの呼び出し上限（0 で無制限）")
+    parser.add_argument("--page-size", type=int, default=500, help="1回に読むプロフィール数（= 1回の書き込み単位）")
+    parser.add_argument("--checkpoint", default="cache/reverify.json", help="進捗の保存先")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から")
+    parser.add_argument("--no-cache", action="store_true", help="判定キャッシュを使わずに必ず問い合わせる")
+    parser.add_argument("--limit", type=int, default=None, help="この件数を読んだら止める")
+    parser.add_argument("--dry-run", action="store_true", help="書き込まずに変わるものだけ表示する")
+    return parser.parse_args()
+
+
+# =====================
+# 呼び出しの間隔
+# =====================
+class RateLimiter:
+    """1分あたり rpm 回まで（呼び出しの開始を等間隔にする）"""
+
+    def __init__(self, rpm: float):
+        self.interval = 60 / rpm if rpm > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+
+# =====================
+# チェックポイント
+# =====================
+def new_checkpoint() -> dict:
+    return {
+        "after": None,
+        "verdict_version": verdictCache.VERDICT_CACHE_VERSION,
+        "scanned": 0,
+        "checked": 0,
+        "changed": 0,
+        "unknown": 0,
+        # 判定が返らなかった・書き込めなかった doc_id（再開しても読み直さないので、後で個別に確認する）
+        "failed": [],
+    }
+
+
+def load_checkpoint(path: str) -> dict:
+    fresh = new_checkpoint()
+    if not os.path.exists(path):
+        return fresh
+
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    # プロンプト・モデルが変わっていれば最初からやり直す
+    if checkpoint.get("verdict_version") != verdictCache.VERDICT_CACHE_VERSION:
+        print("checkpoint is for another VERDICT_CACHE_VERSION, starting over")
+        return fresh
+    return {**fresh, **checkpoint}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + ".part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+# =====================
+# Gemini：まとめて判定
+# =====================
+def build_prompt(trivias: list) -> str:
+    targets = "\n".join(f"[{i}] {trivia}" for i, trivia in enumerate(trivias))
+    return f"""
+            あなたはファクトチェッカーです。
+            以下の各文が事実として正しいかどうかを判断し、JSON で回答してください。
+
+            【ルール】
+            ・results に、番号 index ごとの verdict を1件ずつ入れる
+            ・verdict：正しければ "True"、誤りなら "False"、判断できなければ "Unknown"
+            ・すべての番号に1回ずつ答える。理由、説明、補足は禁止
+
+            【検証対象】
+            {targets}
+            """
+
+
+def parse_verdicts(text: str, count: int) -> dict:
+    """{index: bool | None}。範囲外・重複・不正な値の項目は捨てる"""
+    data = json.loads(text)
+    results = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(results, list):
+        raise ValueError("results is not a list")
+
+    verdicts = {}
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        verdict = item.get("verdict")
+        if (
+            isinstance(index, int) and 0 <= index < count
+            and index not in verdicts and verdict in VERDICTS
+        ):
+            verdicts[index] = VERDICTS[verdict]
+    return verdicts
+
+
+def judge_batch(trivias: list, limiter: RateLimiter) -> dict:
+    """{trivia: bool | None}。答えが返らなかったものは含まない"""
+    limiter.wait()
+    response = llmGateway.generate(
+        build_prompt(trivias),
+        generation_config=genai.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=REVERIFY_SCHEMA,
+        ),
+    )
+    verdicts = parse_verdicts(response.text, len(trivias))
+    return {trivias[i]: verdict for i, verdict in verdicts.items()}
+
+
+# =====================
+# 1ページ分
+# =====================
+def judge_page(trivias: list, args, executor, limiter: RateLimiter) -> dict:
+    """正規化して同じになるトリビアは1回だけ判定する。判定が返らなかったものは含まない"""
+    unique = {}
+    for trivia in trivias:
+        unique.setdefault(verdictCache.normalize(trivia), trivia)
+
+    verdicts = {}
+    pending = []
+    for trivia in unique.values():
+        cached = None if args.no_cache else verdictCache.get(trivia)
+        if cached is not None:
+            verdicts[trivia] = cached
+        else:
+            pending.append(trivia)
+
+    batches = [pending[i:i + args.batch_size] for i in range(0, len(pending), args.batch_size)]
+    futures = [executor.submit(judge_batch, batch, limiter) for batch in batches]
+
+    for batch, future in zip(batches, futures):
+        try:
+            judged = future.result()
+        except Exception as e:
+            print(f"batch failed ({len(batch)} trivia): {e}")
+            continue
+        for trivia, verdict in judged.items():
+            verdictCache.put(trivia, verdict)
+            verdicts[trivia] = verdict
+
+    # 元のトリビアから、同じ正規化の代表の判定を引けるようにする
+    return {
+        trivia: verdicts[unique[verdictCache.normalize(trivia)]]
+        for trivia in trivias
+        if unique[verdictCache.normalize(trivia)] in verdicts
+    }
+
+
+def reverify(store, args):
+    checkpoint = new_checkpoint() if args.restart else load_checkpoint(args.checkpoint)
+    if checkpoint["after"]:
+        print(f"resuming after {checkpoint['after']} ({checkpoint['scanned']} scanned)")
+
+    limiter = RateLimiter(args.rpm)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="reverify")
+    scanned = 0
+
+    try:
+        while args.limit is None or scanned < args.limit:
+            page_size = args.page_size if args.limit is None else min(args.page_size, args.limit - scanned)
+            profiles = store.scan_profiles(checkpoint["after"], page_size)
+            if not profiles:
+                break
+            scanned += len(profiles)
+
+            targets = [p for p in profiles if isinstance(p.get("trivia"), str) and p["trivia"].strip()]
+            verdicts = judge_page([p["trivia"] for p in targets], args, executor, limiter)
+
+            updates = {}
+            changed_cards = []
+            checked = unknown = 0
+            for profile in targets:
+                if profile["trivia"] not in verdicts:
+                    checkpoint["failed"].append(profile["doc_id"])
+                    continue
+                checked += 1
+                verdict = verdicts[profile["trivia"]]
+                # 判断できなかったときは、今の判定を消さない
+                if verdict is None:
+                    unknown += 1
+                    continue
+                if profile.get("is_true") != verdict:
+                    # 移行前の自動IDドキュメントもあるので、読んだ doc_id にそのまま書く
+                    updates[profile["doc_id"]] = {"is_true": verdict}
+                    if profile.get("id") is not None and profile.get("ver") is not None:
+                        changed_cards.append((profile["doc_id"], profile["id"], profile["ver"]))
+                    print(f"{profile['doc_id']}: {profile.get('is_true')} -> {verdict}")
+
+            if updates and not args.dry_run:
+                write_failed = set(store.update_profiles(updates))
+                checkpoint["failed"].extend(sorted(write_failed))
+                # 受け取り済みの端末に変更を伝える
+                for doc_id, user_id, ver in changed_cards:
+                    if doc_id in write_failed:
+                        continue
+                    try:
+                        store.touch_encounters(user_id, ver)
+                    except Exception as e:
+                        print(f"touch failed: {doc_id}: {e}")
+                updates = {k: v for k, v in updates.items() if k not in write_failed}
+
+            checkpoint["after"] = profiles[-1]["doc_id"]
+            checkpoint["scanned"] += len(profiles)
+            checkpoint["checked"] += checked
+            checkpoint["changed"] += len(updates)
+            checkpoint["unknown"] += unknown
+            if not args.dry_run:
+                save_checkpoint(args.checkpoint, checkpoint)
+            print(
+                f"scanned={checkpoint['scanned']} checked={checkpoint['checked']} "
+                f"changed={checkpoint['changed']} unknown={checkpoint['unknown']} "
+                f"failed={len(checkpoint['failed'])}"
+            )
+    finally:
+        executor.shutdown(wait=True)
+
+    return checkpoint
+
+
+# =====================
+# 実行
+# =====================
+if __name__ == "__main__":
+    args = parse_args()
+    databaseConnect.initialize()
+    result = reverify(databaseConnect.get_store(), args)
+    print({
+        **result,
+        "failed": len(result["failed"]),
+        "llm": llmGateway.stats(),
+        "verdict_cache": verdictCache.stats(),
+    })
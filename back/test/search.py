@@ -1,67 +1,33 @@
-from dotenv import load_dotenv
-import os
-import requests
-
-load_dotenv()
-
-SEARCH_API = os.getenv("SEARCH_API")
-URL = "https://api.search.brave.com/res/v1/web/search"
-
-def search(trivia, judgetext):
-    query = f"{trivia} 本当 事実"
+import sys
+from pathlib import Path
 
-    params = {
-        "q": query,
-        "count": 5,
-        "lang": "ja"
-    }
-
-    headers = {
-        "Accept": "application/json",
-        "X-Subscription-Token": SEARCH_API
-    }
-
-    res = requests.get(URL, params=params, headers=headers)
-    res.raise_for_status()
-    data = res.json()
-
-    # return [
-    #     r["description"]
-    #     for r in data.get("web", {}).get("results", [])
-    #     if r.get("description")
-    # ]
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 
+from dotenv import load_dotenv
 
+load_dotenv()
 
-    positive = 0
+import evidenceSearch
 
-    for t in judgetext:
-        if judgetext in t:
-            positive += 1
 
-    if positive >= 2:
-        return {
-            "judgement": "正確",
-        }
-    elif positive == 1:
-        return {
-            "judgement": "一部正確",
-        }
-    else:
-        return {
-            "judgement": "不正確 / 判断不能",
-        }
+def search(trivia):
+    """クエリの言い換えを並列に検索し、関連する結果を返す"""
+    return evidenceSearch.gather(trivia)
 
 
 if __name__ == "__main__":
-    trivia = "タコの心臓は3つある"
+    trivia = sys.argv[1] if len(sys.argv) > 1 else "タコの心臓は3つある"
 
-    texts = search(trivia)
-    # result = judge_trivia(trivia, texts)
+    if not evidenceSearch.enabled():
+        print("SEARCH_API（または SEARCH_API_URL）を設定してください")
+        sys.exit(1)
 
-    output = {
-        # "trivia": trivia,
-        # **result
-    }
+    evidence = search(trivia)
 
-    print(output)
+    print({
+        "trivia": trivia,
+        "confidence": evidenceSearch.confidence(evidence),
+        "evidence": evidence,
+    })
+    print(evidenceSearch.stats())
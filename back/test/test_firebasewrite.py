@@ -0,0 +1,31 @@
+# firebasewrite.iter_json_array の読み取りテスト
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("firebase_admin")
+sys.path.append(str(Path(__file__).resolve().parent.parent / "firebase"))
+
+import firebasewrite  # noqa: E402
+
+
+def read_all(text: str, chunk_size: int, monkeypatch) -> list:
+    monkeypatch.setattr(firebasewrite, "READ_CHUNK_SIZE", chunk_size)
+    return list(firebasewrite.iter_json_array(io.StringIO(text)))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 1 << 16])
+def test_number_split_across_chunks(chunk_size, monkeypatch):
+    rows = read_all("[12345, 678, {\"id\": \"a\", \"ver\": 1}]", chunk_size, monkeypatch)
+    assert [(n, v) for n, v, _, _ in rows] == [(1, 12345), (2, 678), (3, {"id": "a", "ver": 1})]
+
+
+@pytest.mark.parametrize("chunk_size", [3, 8, 1 << 16])
+def test_malformed_element_is_skipped(chunk_size, monkeypatch):
+    text = '[{"id": "a", "ver": 1}, {"id": "b", "x": [1,2,}, {"id": "c,\\"]", "ver": 3}]'
+    rows = read_all(text, chunk_size, monkeypatch)
+    assert [n for n, _, _, _ in rows] == [1, 2, 3]
+    assert rows[1][1] is None and rows[1][2].startswith("invalid json")
+    assert rows[2][1] == {"id": 'c,"]', "ver": 3}
@@ -1,18 +1,11 @@
-import os
-from dotenv import load_dotenv
-import google.generativeai as genai
+import sys
+from pathlib import Path
 
-def trivia_trueorfalse(trivia: str):
-    load_dotenv(override=True)
-
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
-
-    genai.configure(api_key=api_key)
-
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import llmGateway
 
+def trivia_trueorfalse(trivia: str):
     prompt = f"""
     あなたはファクトチェッカーです。
     以下の文が事実として正しいかどうかを判断してください。
@@ -27,8 +20,7 @@ def trivia_trueorfalse(trivia: str):
     {trivia}
     """
 
-    response = model.generate_content(prompt)
-    text = response.text.strip()
+    text = llmGateway.generate_text(prompt)
 
     print("LLM出力:", text)
 
@@ -0,0 +1,184 @@
+import base64
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from google.api_core import exceptions as google_exceptions
+from PIL import Image
+
+# =====================
+# 遅延の分布
+# =====================
+def parse_latency(spec: str):
+    """
+    "fixed:500" / "uniform:200,1200" / "normal:800,150" / "lognormal:800,0.4"
+    （単位はミリ秒、lognormal は中央値と sigma）から、秒を返す関数を作る
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1])) / 1000
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma) / 1000
+    raise ValueError(f"unknown latency spec: {spec}")
+
+
+def _stable_hash(text: str) -> int:
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+# =====================
+# Gemini の代わり（llmGateway.set_model に渡す）
+# =====================
+class FakeGeminiModel:
+    """決まった判定・プロンプトを、指定の遅延で返す"""
+
+    def __init__(self, latency, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    @staticmethod
+    def _trivia(prompt: str) -> str:
+        if "【検証対象】" in prompt:
+            return prompt.split("【検証対象】", 1)[1].strip()
+        return prompt.split("\n", 1)[0].strip()
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        time.sleep(self.latency())
+        if random.random() < self.error_rate:
+            raise google_exceptions.ResourceExhausted("fake rate limit")
+
+        trivia = self._trivia(prompt)
+        seed = _stable_hash(trivia)
+        verdict = "True" if seed % 3 else "False"
+        sd_prompt = f"trivia {seed % 1000}, card, Hand-drawn, Deformed, Pastel colors"
+
+        if getattr(generation_config, "response_mime_type", None) == "application/json":
+            text = json.dumps({"verdict": verdict, "sd_prompt": sd_prompt})
+        elif "True または False" in prompt:
+            text = verdict
+        else:
+            text = sd_prompt
+
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=len(prompt) // 4,
+                candidates_token_count=len(text) // 4,
+                total_token_count=(len(prompt) + len(text)) // 4,
+            ),
+        )
+
+
+# =====================
+# SD WebUI の代わり（/sdapi/v1/txt2img と /sdapi/v1/progress だけ）
+# =====================
+# この steps のときに latency どおりの遅延になる（steps に比例させる）
+REFERENCE_STEPS = 35
+
+_png_cache = {}
+_png_lock = threading.Lock()
+
+
+def _png_base64(width: int, height: int) -> str:
+    key = (width, height)
+    with _png_lock:
+        if key not in _png_cache:
+            image = Image.new("RGB", (width, height), (250, 220, 235))
+            out = io.BytesIO()
+            image.save(out, format="PNG")
+            _png_cache[key] = base64.b64encode(out.getvalue()).decode("ascii")
+        return _png_cache[key]
+
+
+def start_sd_server(latency, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """別スレッドで起動し、サーバーを返す（URL は server.url）"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.startswith("/sdapi/v1/progress"):
+                self._send_json(200, {"progress": 0.0, "eta_relative": 0.0})
+            else:
+                self._send_json(404, {"detail": "Not Found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", "0"))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.startswith("/sdapi/v1/txt2img"):
+                self._send_json(404, {"detail": "Not Found"})
+                return
+
+            steps = int(payload.get("steps", REFERENCE_STEPS))
+            time.sleep(latency() * steps / REFERENCE_STEPS)
+            image = _png_base64(int(payload.get("width", 512)), int(payload.get("height", 512)))
+            self._send_json(200, {"images": [image], "parameters": payload, "info": "{}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="fake-sd", daemon=True).start()
+    return server
+
+
+# =====================
+# Web 検索の代わり（Brave の /res/v1/web/search と同じ形）
+# =====================
+def start_search_server(latency, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """クエリをそのまま含む結果を返す（SEARCH_API_URL に server.url を渡す）"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+            time.sleep(latency())
+            seed = _stable_hash(query)
+            body = json.dumps({
+                "web": {
+                    "results": [
+                        {
+                            "title": f"{query} について",
+                            "description": f"<strong>{query}</strong> は本当です。（{i}）",
+                            "url": f"https://example.com/{seed}/{i}",
+                        }
+                        for i in range(3)
+                    ],
+                },
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}/res/v1/web/search"
+    threading.Thread(target=server.serve_forever, name="fake-search", daemon=True).start()
+    return server
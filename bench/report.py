@@ -0,0 +1,142 @@
+import json
+import math
+import threading
+
+# ヒストグラムの区切り（ミリ秒、上限を含む）
+HISTOGRAM_BOUNDS_MS = (
+    1, 2, 5, 10, 20, 50, 100, 200, 500,
+    1000, 2000, 5000, 10000, 20000, 60000, math.inf,
+)
+# 比較する指標（値が大きいほど悪いもの）
+LATENCY_METRICS = ("p50_ms", "p90_ms", "p99_ms")
+
+
+# =====================
+# 記録
+# =====================
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._errors = {}
+
+    def record(self, op: str, latency_sec: float, ok: bool = True):
+        with self._lock:
+            if ok:
+                self._samples.setdefault(op, []).append(latency_sec * 1000)
+            else:
+                self._errors[op] = self._errors.get(op, 0) + 1
+                self._samples.setdefault(op, [])
+
+    def summary(self, elapsed_sec: float) -> dict:
+        with self._lock:
+            samples = {op: sorted(values) for op, values in self._samples.items()}
+            errors = dict(self._errors)
+        return {
+            op: summarize(values, errors.get(op, 0), elapsed_sec)
+            for op, values in sorted(samples.items())
+        }
+
+
+def _percentile(values: list, q: float) -> float:
+    """values はソート済み（最近傍法）"""
+    if not values:
+        return 0.0
+    index = max(0, math.ceil(q * len(values)) - 1)
+    return values[index]
+
+
+def summarize(values: list, errors: int, elapsed_sec: float) -> dict:
+    histogram = []
+    start = 0
+    for bound in HISTOGRAM_BOUNDS_MS:
+        end = start
+        while end < len(values) and values[end] <= bound:
+            end += 1
+        histogram.append(["inf" if bound == math.inf else bound, end - start])
+        start = end
+
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput_rps": len(values) / elapsed_sec if elapsed_sec else 0.0,
+        "mean_ms": sum(values) / len(values) if values else 0.0,
+        "p50_ms": _percentile(values, 0.50),
+        "p90_ms": _percentile(values, 0.90),
+        "p99_ms": _percentile(values, 0.99),
+        "max_ms": values[-1] if values else 0.0,
+        "histogram": histogram,
+    }
+
+
+# =====================
+# 表示
+# =====================
+def print_summary(ops: dict):
+    print(f"{'op':<28}{'count':>8}{'err':>6}{'rps':>9}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for op, s in ops.items():
+        print(
+            f"{op:<28}{s['count']:>8}{s['errors']:>6}{s['throughput_rps']:>9.1f}"
+            f"{s['p50_ms']:>10.1f}{s['p90_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}"
+        )
+
+
+def print_histograms(ops: dict, width: int = 40):
+    for op, s in ops.items():
+        if not s["count"]:
+            continue
+        print(f"\n{op} (ms)")
+        peak = max(count for _, count in s["histogram"])
+        for bound, count in s["histogram"]:
+            if not count:
+                continue
+            bar = "#" * max(1, round(count / peak * width))
+            print(f"  <= {str(bound):>6} {count:>7} {bar}")
+
+
+# =====================
+# 基準との比較
+# =====================
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """
+    基準より threshold（割合）以上悪化した指標を返す。
+    レイテンシは増加、スループットは減少、エラーは増加を悪化とみなす。
+    """
+    regressions = []
+    for op, base in baseline["ops"].items():
+        now = current["ops"].get(op)
+        if now is None:
+            continue
+
+        for metric in LATENCY_METRICS:
+            if base[metric] and now[metric] > base[metric] * (1 + threshold):
+                regressions.append((op, metric, base[metric], now[metric]))
+
+        if base["throughput_rps"] and now["throughput_rps"] < base["throughput_rps"] * (1 - threshold):
+            regressions.append((op, "throughput_rps", base["throughput_rps"], now["throughput_rps"]))
+
+        if now["errors"] > base["errors"]:
+            regressions.append((op, "errors", base["errors"], now["errors"]))
+    return regressions
+
+
+def print_comparison(current: dict, baseline: dict):
+    print(f"\n{'op':<28}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for op, base in baseline["ops"].items():
+        now = current["ops"].get(op)
+        if now is None:
+            continue
+        for metric in (*LATENCY_METRICS, "throughput_rps"):
+            change = (now[metric] / base[metric] - 1) * 100 if base[metric] else 0.0
+            print(f"{op:<28}{metric:<16}{base[metric]:>12.1f}{now[metric]:>12.1f}{change:>+9.1f}%")
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(path: str, result: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,299 @@
+"""
+apiResponse.py の負荷試験・ベンチマーク。
+
+Gemini・SD・保存先をすべてローカルの代わりに差し替えて FastAPI アプリを起動し、
+save_profile / get_otheruser_profiles / heyplus を指定の割合で投げ続ける。
+
+  python bench/run_bench.py --duration 60 --concurrency 16 --output bench/result.json
+  python bench/run_bench.py --baseline bench/baseline.json --fail-on-regression
+"""
+import argparse
+import datetime
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import requests
+
+import fakes
+import report
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+# .env はここで先に読ませ、以降で設定する値が上書きされないようにする
+import envConfig  # noqa: E402,F401
+import llmGateway  # noqa: E402
+
+OPS = ("save_profile", "get_otheruser_profiles", "heyplus")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="apiResponse.py の負荷試験")
+    parser.add_argument("--duration", type=float, default=30, help="計測する秒数")
+    parser.add_argument("--warmup", type=float, default=3, help="計測前に流す秒数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に投げるクライアント数")
+    parser.add_argument(
+        "--mix", default="save_profile=1,get_otheruser_profiles=6,heyplus=3",
+        help="エンドポイントごとの割合",
+    )
+    parser.add_argument("--profiles", type=int, default=1000, help="事前に入れておくプロフィール数")
+    parser.add_argument("--batch-size", type=int, default=20, help="get_otheruser_profiles 1回あたりの件数")
+    parser.add_argument("--trivia-pool", type=int, default=50, help="save_profile で使うトリビアの種類")
+    parser.add_argument("--gemini-latency", default="lognormal:800,0.4")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--sd-latency", default="lognormal:4000,0.3")
+    parser.add_argument("--sd-backends", type=int, default=1, help="起動する SD の代わりの数")
+    parser.add_argument("--search-latency", default=None, help="指定すると Web 検索の代わりも起動する")
+    parser.add_argument("--datastore", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--job-workers", type=int, default=None)
+    parser.add_argument("--poll-ms", type=int, default=100, help="/jobs を確認する間隔")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON を書き出す先")
+    parser.add_argument("--baseline", help="比較する過去の結果 JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="悪化とみなす割合")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    return parser.parse_args()
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError(f"unknown op in --mix: {op}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except Exception:
+        return None
+
+
+# =====================
+# アプリの準備
+# =====================
+def configure_env(args, workdir: str, sd_servers: list, search_server, port: int):
+    os.environ["DATASTORE_BACKEND"] = args.datastore
+    os.environ["DATASTORE_SQLITE_PATH"] = os.path.join(workdir, "profiles.sqlite3")
+    os.environ["LOCAL_STORAGE_DIR"] = os.path.join(workdir, "storage")
+    os.environ["LOCAL_STORAGE_BASE_URL"] = f"http://127.0.0.1:{port}/local-storage"
+    # 前回の実行のキャッシュを使わない
+    os.environ["VERDICT_CACHE_PATH"] = os.path.join(workdir, "verdicts.sqlite3")
+    os.environ["CARD_CACHE_PATH"] = os.path.join(workdir, "cards.sqlite3")
+    os.environ["SD_BACKENDS"] = ",".join(server.url for server in sd_servers)
+    if search_server is not None:
+        os.environ["SEARCH_API_URL"] = search_server.url
+    # 計測中に作り直しのジョブを混ぜない
+    os.environ["QUALITY_RERENDER_INTERVAL_SEC"] = "86400"
+    if args.job_workers is not None:
+        os.environ["JOB_WORKERS"] = str(args.job_workers)
+
+
+def seed_profiles(store, count: int) -> list:
+    keys = []
+    for i in range(count):
+        user_id = f"seed-{i:06d}"
+        store.create_profile({
+            "nickname": f"user{i}",
+            "birthday": f"{i % 12 + 1:02d}/{i % 28 + 1:02d}",
+            "birthplace": "北海道",
+            "trivia": f"シードのトリビア{i}",
+            "is_true": bool(i % 2),
+            "image_url": None,
+            "ver": 1,
+            "id": user_id,
+            "created_at": datetime.datetime.now(),
+        })
+        keys.append((user_id, 1))
+    return keys
+
+
+def start_server(app, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("server failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+
+# =====================
+# 負荷
+# =====================
+class Client:
+
+    def __init__(self, base_url: str, args, keys: list, recorder: report.Recorder):
+        self.base_url = base_url
+        self.args = args
+        self.keys = keys
+        self.recorder = recorder
+        self.session = requests.Session()
+
+    def _timed(self, op: str, method: str, path: str, body=None):
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.base_url + path, json=body, timeout=300)
+            ok = r.status_code < 400
+        except requests.RequestException:
+            r, ok = None, False
+        self.recorder.record(op, time.perf_counter() - start, ok)
+        return r if ok else None
+
+    def save_profile(self):
+        start = time.perf_counter()
+        r = self._timed("save_profile", "POST", "/save_profile", {
+            "nickname": "bench",
+            "birthday": "01/01",
+            "birthplace": "北海道",
+            "trivia": f"ベンチ用のトリビア{random.randrange(self.args.trivia_pool)}",
+            "id": f"bench-{uuid.uuid4().hex[:12]}",
+            "ver": 1,
+            "hey": 0,
+        })
+        if r is None:
+            return
+
+        # カードができるまでクライアントと同じように待つ
+        status_url = r.json()["status_url"]
+        while True:
+            time.sleep(self.args.poll_ms / 1000)
+            job = self.session.get(self.base_url + status_url, timeout=30).json()
+            if job["state"] in ("succeeded", "failed"):
+                break
+        self.recorder.record(
+            "save_profile.job", time.perf_counter() - start, job["state"] == "succeeded"
+        )
+
+    def get_otheruser_profiles(self):
+        targets = random.sample(self.keys, min(self.args.batch_size, len(self.keys)))
+        self._timed("get_otheruser_profiles", "POST", "/get_otheruser_profiles", {
+            "targets": {user_id: ver for user_id, ver in targets},
+        })
+
+    def heyplus(self):
+        user_id, ver = random.choice(self.keys)
+        self._timed("heyplus", "POST", "/heyplus", {"id": user_id, "ver": ver, "pushedhey": 1})
+
+
+def run_load(base_url: str, args, keys: list, mix: dict, duration: float) -> tuple[report.Recorder, float]:
+    recorder = report.Recorder()
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    deadline = time.monotonic() + duration
+
+    def worker():
+        client = Client(base_url, args, keys, recorder)
+        while time.monotonic() < deadline:
+            op = random.choices(ops, weights)[0]
+            getattr(client, op)()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+# =====================
+# main
+# =====================
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    port = free_port()
+    sd_servers = [
+        fakes.start_sd_server(fakes.parse_latency(args.sd_latency))
+        for _ in range(args.sd_backends)
+    ]
+    search_server = None
+    if args.search_latency:
+        search_server = fakes.start_search_server(fakes.parse_latency(args.search_latency))
+    configure_env(args, workdir, sd_servers, search_server, port)
+
+    import apiResponse
+    import databaseConnect
+
+    llmGateway.set_model(fakes.FakeGeminiModel(
+        fakes.parse_latency(args.gemini_latency), args.gemini_error_rate
+    ))
+    keys = seed_profiles(databaseConnect.get_store(), args.profiles)
+
+    server, thread = start_server(apiResponse.app, port)
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"workdir: {workdir}")
+
+    if args.warmup > 0:
+        run_load(base_url, args, keys, mix, args.warmup)
+    recorder, elapsed = run_load(base_url, args, keys, mix, args.duration)
+
+    server_stats = {
+        "sd": requests.get(base_url + "/sd/stats", timeout=10).json(),
+        "llm": requests.get(base_url + "/llm/stats", timeout=10).json(),
+    }
+    server.should_exit = True
+    thread.join()
+    for sd in sd_servers:
+        sd.shutdown()
+    if search_server is not None:
+        search_server.shutdown()
+
+    result = {
+        "meta": {
+            "revision": git_revision(),
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "elapsed_sec": elapsed,
+            "args": vars(args),
+        },
+        "ops": recorder.summary(elapsed),
+        "server": server_stats,
+    }
+
+    report.print_summary(result["ops"])
+    report.print_histograms(result["ops"])
+    if args.output:
+        report.save(args.output, result)
+        print(f"\nsaved: {args.output}")
+
+    if args.baseline:
+        baseline = report.load(args.baseline)
+        report.print_comparison(result, baseline)
+        regressions = report.compare(result, baseline, args.threshold)
+        for op, metric, before, after in regressions:
+            print(f"REGRESSION {op} {metric}: {before:.1f} -> {after:.1f}")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
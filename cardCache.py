@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+# =====================
+# 設定
+# =====================
+CARD_CACHE_PATH = os.getenv("CARD_CACHE_PATH", "cache/cards.sqlite3")
+
+_lock = threading.Lock()
+_conn = None
+# 処理中のキー → 結果を待つ Future（同じ入力・同じカードの同時リクエストを1回にまとめる）
+_inflight = {}
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+    "stale": 0,
+}
+
+
+# =====================
+# キー
+# =====================
+def pinned_seed(prompt: str) -> int:
+    """同じプロンプトなら同じ画像になるよう seed を固定する"""
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") & 0x7FFFFFFF
+
+
+def payload_hash(payload: dict) -> str:
+    """SD に送るペイロード全体のハッシュ"""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# =====================
+# SQLite
+# =====================
+def _db():
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(CARD_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(CARD_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cards (
+                payload_hash TEXT PRIMARY KEY,
+                blob_name TEXT NOT NULL,
+                image_url TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                variants TEXT
+            )
+            """
+        )
+        # 派生画像の URL を持つ前に作ったテーブルには列を足す（既存の行は派生画像なし）
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cards)")}
+        if "variants" not in columns:
+            conn.execute("ALTER TABLE cards ADD COLUMN variants TEXT")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _lookup(key: str) -> tuple | None:
+    """(blob_name, image_url, 派生画像の URL or None)"""
+    with _lock:
+        row = _db().execute(
+            "SELECT blob_name, image_url, variants FROM cards WHERE payload_hash = ?",
+            (key,),
+        ).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1], json.loads(row[2]) if row[2] else None
+
+
+def _store(key: str, blob_name: str, image_url: str, variants: dict | None):
+    with _lock:
+        conn = _db()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO cards (payload_hash, blob_name, image_url, created_at, variants)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (key, blob_name, image_url, time.time(), json.dumps(variants) if variants else None),
+        )
+        conn.commit()
+
+
+def _forget(key: str):
+    with _lock:
+        conn = _db()
+        conn.execute("DELETE FROM cards WHERE payload_hash = ?", (key,))
+        conn.commit()
+
+
+def _count(name: str):
+    with _lock:
+        _stats[name] += 1
+
+
+# =====================
+# 同時リクエストをまとめる
+# =====================
+def singleflight(key, fn):
+    """
+    同じ key の fn() が実行中なら、その結果を待って返す（fn は1回だけ動く）。
+    key はハッシュ文字列でも (id, ver) などのタプルでもよい
+    """
+    with _lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        _count("coalesced")
+        return future.result()
+
+    try:
+        result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+# =====================
+# 取得 or 生成
+# =====================
+def get_or_create(payload: dict, create, exists=None) -> tuple:
+    """
+    payload と同じ入力で作った画像があればその (blob_name, image_url, 派生画像の URL) を返す。
+    なければ create(payload_hash) -> (blob_name, image_url, 派生画像の URL) で作って登録する。
+    派生画像の URL は作ったときに記録したもの（記録がなければ None）。
+    exists(blob_name) を渡すと、ヒット時に Blob が残っているか確認する。
+    """
+    key = payload_hash(payload)
+
+    row = _lookup(key)
+    if row is not None:
+        if exists is None or exists(row[0]):
+            _count("hits")
+            return row
+        _count("stale")
+        _forget(key)
+
+    def create_once():
+        # 直前に別スレッドが登録し終えていることがある
+        row = _lookup(key)
+        if row is not None:
+            _count("hits")
+            return row
+
+        _count("misses")
+        blob_name, image_url, variants = create(key)
+        _store(key, blob_name, image_url, variants)
+        return blob_name, image_url, variants
+
+    return singleflight(key, create_once)
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["inflight"] = len(_inflight)
+    return snapshot
@@ -0,0 +1,99 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, features
+
+# =====================
+# 設定
+# =====================
+# 派生画像の種類と長辺のピクセル数
+CARD_VARIANT_SIZES = {
+    "thumb": int(os.getenv("CARD_THUMB_SIZE", "160")),
+    "display": int(os.getenv("CARD_DISPLAY_SIZE", "384")),
+}
+# 作る形式（avif は Pillow が対応していれば）
+CARD_VARIANT_FORMATS = [
+    fmt.strip().lower()
+    for fmt in os.getenv("CARD_VARIANT_FORMATS", "webp").split(",")
+    if fmt.strip()
+]
+CARD_VARIANT_QUALITY = int(os.getenv("CARD_VARIANT_QUALITY", "80"))
+CARD_VARIANT_WORKERS = int(os.getenv("CARD_VARIANT_WORKERS", "2"))
+
+CONTENT_TYPES = {
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _supported(fmt: str) -> bool:
+    if fmt == "webp":
+        return features.check("webp")
+    if fmt == "avif":
+        try:
+            return bool(features.check("avif"))
+        except ValueError:
+            # 古い Pillow は avif を知らない
+            return False
+    return False
+
+
+FORMATS = [fmt for fmt in CARD_VARIANT_FORMATS if fmt in CONTENT_TYPES and _supported(fmt)]
+
+
+# =====================
+# 名前
+# =====================
+def variant_name(blob_name: str, kind: str, fmt: str) -> str:
+    """cards/abc_v1.png → cards/abc_v1_thumb.webp"""
+    base, _ = os.path.splitext(blob_name)
+    return f"{base}_{kind}.{fmt}"
+
+
+# =====================
+# エンコード（子プロセスで実行）
+# =====================
+def render_variants(png_path: str) -> dict:
+    """{(kind, fmt): エンコード済みバイト列}。元画像はファイルから読む（バイト列ごとプロセス間で渡さない）"""
+    results = {}
+    with Image.open(png_path) as source:
+        source = source.convert("RGB")
+        for kind, size in CARD_VARIANT_SIZES.items():
+            image = source.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+            for fmt in FORMATS:
+                out = io.BytesIO()
+                image.save(out, format=fmt.upper(), quality=CARD_VARIANT_QUALITY)
+                results[(kind, fmt)] = out.getvalue()
+    return results
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # スレッドを持つサーバープロセスからの fork を避ける
+            _pool = ProcessPoolExecutor(
+                max_workers=CARD_VARIANT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def submit(png_path: str):
+    """派生画像の作成をプロセスプールに投げ、Future を返す（結果が出るまで png_path を消さないこと）"""
+    return _get_pool().submit(render_variants, png_path)
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
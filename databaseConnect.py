@@ -1,34 +1,84 @@
-import firebase_admin
-from firebase_admin import credentials, firestore, storage
+import os
+
+import profileStore
+import localBucket
+import metrics
+
+# 保存先：firestore（本番） / sqlite / memory（ローカルでの計測・負荷試験用）
+DATASTORE_BACKEND = os.getenv("DATASTORE_BACKEND", "firestore").lower()
+DATASTORE_SQLITE_PATH = os.getenv("DATASTORE_SQLITE_PATH", "cache/profiles.sqlite3")
+# firestore 以外のときの画像の置き場所と、その公開URL
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "cache/storage")
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL", "http://127.0.0.1:8000/local-storage")
 
 # 初期化状態を管理する変数
 _db = None
+_async_db = None
 _bucket = None
+_store = None
 
 # ★ここが重要！関数名を 'initialize' に統一します
 def initialize():
-    """Firebaseを初期化し、DBとBucketへの接続を確立する"""
-    global _db, _bucket
-    
+    """保存先を初期化し、DB（プロフィールの保存先）とBucketへの接続を確立する"""
+    global _bucket, _store
+
     # すでに初期化済みなら何もしない（二重初期化防止）
+    if _store is not None:
+        return
+
+    if DATASTORE_BACKEND == "firestore":
+        _initialize_firebase()
+        _store = profileStore.FirestoreProfileStore(_db, _async_db)
+    elif DATASTORE_BACKEND == "sqlite":
+        _store = profileStore.SQLiteProfileStore(DATASTORE_SQLITE_PATH)
+        _bucket = localBucket.LocalBucket(LOCAL_STORAGE_DIR, LOCAL_STORAGE_BASE_URL)
+        print(f"--- SQLite datastore: {DATASTORE_SQLITE_PATH} ---")
+    elif DATASTORE_BACKEND == "memory":
+        _store = profileStore.MemoryProfileStore()
+        _bucket = localBucket.LocalBucket(LOCAL_STORAGE_DIR, LOCAL_STORAGE_BASE_URL)
+        print("--- In-memory datastore ---")
+    else:
+        raise ValueError(f"unknown DATASTORE_BACKEND: {DATASTORE_BACKEND}")
+
+    # 呼び出しごとの所要時間を datastore.<メソッド名> で記録する
+    _store = metrics.instrument(_store, "datastore")
+
+def _initialize_firebase():
+    """Firebaseを初期化する（ローカルの保存先では firebase_admin を読み込まない）"""
+    global _db, _async_db, _bucket
+    import firebase_admin
+    from firebase_admin import credentials, firestore, storage
+    from google.cloud.firestore import AsyncClient
+
     if not firebase_admin._apps:
         # 鍵ファイルの読み込み
         cred = credentials.Certificate("serviceAccountKey.json")
-        
+
         # 初期化（バケット名はあなたのプロジェクトIDに合わせています）
         firebase_admin.initialize_app(cred, {
-            'storageBucket': 'hakodate-ar-2025.firebasestorage.app' 
+            'storageBucket': 'hakodate-ar-2025.firebasestorage.app'
         })
-        
-        _db = firestore.client()
-        _bucket = storage.bucket()
         print("--- Firebase Connected ---")
-    else:
-        _db = firestore.client()
-        _bucket = storage.bucket()
+
+    _db = firestore.client()
+    _bucket = storage.bucket()
+    # async のエンドポイントからの読み取り用（firebase_admin には非同期版がないので同じ鍵で作る）
+    app = firebase_admin.get_app()
+    _async_db = AsyncClient(project=app.project_id, credentials=app.credential.get_credential())
+
+def is_local() -> bool:
+    return DATASTORE_BACKEND != "firestore"
 
 def get_db():
+    """Firestore のクライアント（firestore 以外では None）"""
     return _db
 
+def get_async_db():
+    """Firestore の非同期クライアント（firestore 以外では None）"""
+    return _async_db
+
 def get_bucket():
-    return _bucket
\ No newline at end of file
+    return _bucket
+
+def get_store():
+    return _store
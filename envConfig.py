@@ -0,0 +1,9 @@
+from dotenv import load_dotenv
+
+# =====================
+# .env の読み込み
+# =====================
+# 各モジュールは import 時に os.getenv で設定を読むので、
+# エントリポイントでは他のモジュールより先にこれを import する。
+# モジュールとして1回だけ実行されるので、後から設定した環境変数は上書きしない。
+load_dotenv(override=True)
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import threading
+
+# =====================
+# 設定
+# =====================
+# 1購読あたりに溜めておくイベント数（溢れたら古いものから捨てる）
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+# hey の変化はこの間隔でまとめて1回だけ送る
+HEY_EVENT_COALESCE_MS = int(os.getenv("HEY_EVENT_COALESCE_MS", "500"))
+# 1購読あたりのカード数の上限
+MAX_EVENT_TOPICS = int(os.getenv("MAX_EVENT_TOPICS", "1000"))
+
+# 購読の登録・配送はイベントループのスレッドだけで行う
+_loop = None
+_flush_task = None
+# (id, ver) → {Subscription}
+_subscribers = {}
+
+_lock = threading.Lock()
+# (id, ver) → まだ送っていない最新の hey
+_hey_pending = {}
+_stats = {
+    "published": 0,
+    "delivered": 0,
+    "dropped": 0,
+    "hey_coalesced": 0,
+}
+
+
+class Subscription:
+    """1接続分の購読（キューからイベントを取り出して送る）"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.keys = set()
+
+    def _deliver(self, event: dict):
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+        with _lock:
+            _stats["delivered"] += 1
+            _stats["dropped"] += dropped
+
+    async def get(self, timeout: float) -> dict | None:
+        """次のイベント（timeout 秒来なければ None）"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# =====================
+# 起動・停止（イベントループ上で呼ぶ）
+# =====================
+def start():
+    global _loop, _flush_task
+    _loop = asyncio.get_running_loop()
+    if _flush_task is None:
+        _flush_task = _loop.create_task(_hey_flush_loop())
+
+
+async def stop():
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+
+
+# =====================
+# 購読（イベントループ上で呼ぶ）
+# =====================
+def subscribe(keys=()) -> Subscription:
+    subscription = Subscription()
+    update(subscription, add=keys)
+    return subscription
+
+
+def update(subscription: Subscription, add=(), remove=()):
+    """購読するカードを増減する。合計が MAX_EVENT_TOPICS を超えるなら何も変えずに ValueError"""
+    add = list(add)
+    remove = list(remove)
+    if len((subscription.keys | set(add)) - set(remove)) > MAX_EVENT_TOPICS:
+        raise ValueError(f"Too many topics (max {MAX_EVENT_TOPICS})")
+
+    for key in add:
+        subscription.keys.add(key)
+        _subscribers.setdefault(key, set()).add(subscription)
+    for key in remove:
+        subscription.keys.discard(key)
+        holders = _subscribers.get(key)
+        if holders is not None:
+            holders.discard(subscription)
+            if not holders:
+                del _subscribers[key]
+
+
+def unsubscribe(subscription: Subscription):
+    update(subscription, remove=list(subscription.keys))
+
+
+# =====================
+# 配信（どのスレッドからでも呼べる）
+# =====================
+def _dispatch(key, event: dict):
+    for subscription in list(_subscribers.get(key, ())):
+        subscription._deliver(event)
+
+
+def publish(key, event: dict):
+    """(id, ver) の購読者に event を送る。ループが動いていなければ捨てる"""
+    if _loop is None or _loop.is_closed():
+        return
+    with _lock:
+        _stats["published"] += 1
+    _loop.call_soon_threadsafe(_dispatch, key, event)
+
+
+def publish_hey(key, hey: int):
+    """hey の合計の変化。短時間の連打は最新値1回にまとめる"""
+    with _lock:
+        if key in _hey_pending:
+            _stats["hey_coalesced"] += 1
+        _hey_pending[key] = hey
+
+
+async def _hey_flush_loop():
+    while True:
+        await asyncio.sleep(HEY_EVENT_COALESCE_MS / 1000)
+        with _lock:
+            items = list(_hey_pending.items())
+            _hey_pending.clear()
+            _stats["published"] += len(items)
+        for (user_id, ver), hey in items:
+            _dispatch((user_id, ver), {"type": "hey", "id": user_id, "ver": ver, "hey": hey})
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+    snapshot["topics"] = len(_subscribers)
+    snapshot["subscriptions"] = len({s for subs in _subscribers.values() for s in subs})
+    return snapshot
@@ -0,0 +1,194 @@
+import contextvars
+import html
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from verdictCache import normalize
+
+# =====================
+# 設定
+# =====================
+BRAVE_SEARCH_URL = "https://api.search.brave.com/res/v1/web/search"
+SEARCH_API = os.getenv("SEARCH_API")
+# ローカルの代わりのサーバーで試すときに差し替える
+SEARCH_API_URL = os.getenv("SEARCH_API_URL", BRAVE_SEARCH_URL)
+# 1クエリあたりの待ち時間（全クエリは並列なので、追加の待ちはこれが上限）
+SEARCH_TIMEOUT_SEC = float(os.getenv("SEARCH_TIMEOUT_SEC", "2.0"))
+SEARCH_RESULT_COUNT = int(os.getenv("SEARCH_RESULT_COUNT", "5"))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_CACHE_TTL_SEC = float(os.getenv("SEARCH_CACHE_TTL_SEC", str(24 * 3600)))
+# 関連する根拠がこの件数集まったら残りのクエリを待たない
+EVIDENCE_TARGET_SNIPPETS = int(os.getenv("EVIDENCE_TARGET_SNIPPETS", "3"))
+EVIDENCE_CONFIDENCE = float(os.getenv("EVIDENCE_CONFIDENCE", "1.0"))
+# トリビアの語（2文字単位）がこの割合以上含まれていれば関連ありとみなす
+EVIDENCE_MIN_RELEVANCE = float(os.getenv("EVIDENCE_MIN_RELEVANCE", "0.3"))
+EVIDENCE_MAX_SNIPPETS = int(os.getenv("EVIDENCE_MAX_SNIPPETS", "5"))
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=SEARCH_WORKERS))
+_session.mount("http://", HTTPAdapter(pool_maxsize=SEARCH_WORKERS))
+_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+_lock = threading.Lock()
+# クエリ → (結果, 取得時刻)
+_cache = OrderedDict()
+_stats = {
+    "gathers": 0,
+    "queries": 0,
+    "cache_hits": 0,
+    "errors": 0,
+    "timeouts": 0,
+    "early_exits": 0,
+}
+
+
+def enabled() -> bool:
+    """API キーがあるか、検索先が差し替えられていれば使う"""
+    return bool(SEARCH_API) or SEARCH_API_URL != BRAVE_SEARCH_URL
+
+
+# =====================
+# 検索（1クエリ）
+# =====================
+_TAG = re.compile(r"<[^>]+>")
+
+
+def _clean(text: str) -> str:
+    return html.unescape(_TAG.sub("", text or "")).strip()
+
+
+def search(query: str) -> list:
+    """[{title, snippet, url}]（結果はキャッシュする）"""
+    with _lock:
+        entry = _cache.get(query)
+        if entry is not None and entry[1] >= time.monotonic() - SEARCH_CACHE_TTL_SEC:
+            _cache.move_to_end(query)
+            _stats["cache_hits"] += 1
+            return entry[0]
+        _stats["queries"] += 1
+
+    headers = {"Accept": "application/json"}
+    if SEARCH_API:
+        headers["X-Subscription-Token"] = SEARCH_API
+
+    with metrics.timer("search"):
+        res = _session.get(
+            SEARCH_API_URL,
+            params={"q": query, "count": SEARCH_RESULT_COUNT, "search_lang": "jp"},
+            headers=headers,
+            timeout=SEARCH_TIMEOUT_SEC,
+        )
+        res.raise_for_status()
+        data = res.json()
+
+    results = [
+        {
+            "title": _clean(r.get("title")),
+            "snippet": _clean(r.get("description")),
+            "url": r.get("url"),
+        }
+        for r in data.get("web", {}).get("results", [])
+        if r.get("description")
+    ]
+
+    with _lock:
+        _cache[query] = (results, time.monotonic())
+        _cache.move_to_end(query)
+        while len(_cache) > SEARCH_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return results
+
+
+# =====================
+# 根拠集め（複数クエリを並列に）
+# =====================
+def query_variants(trivia: str) -> list:
+    return [trivia, f"{trivia} 本当", f"{trivia} 嘘 デマ"]
+
+
+def _terms(text: str) -> set:
+    """正規化した文字列の2文字ずつ（日本語は分かち書きしないため）"""
+    text = normalize(text)
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def relevance(trivia_terms: set, text: str) -> float:
+    if not trivia_terms:
+        return 0.0
+    return len(trivia_terms & _terms(text)) / len(trivia_terms)
+
+
+def confidence(evidence: list) -> float:
+    return min(1.0, len(evidence) / EVIDENCE_TARGET_SNIPPETS) if EVIDENCE_TARGET_SNIPPETS else 1.0
+
+
+def gather(trivia: str) -> list:
+    """
+    クエリの言い換えを並列に投げ、関連する結果を [{title, snippet, url, relevance}] で返す。
+    待つのは最も遅いクエリまで（上限 SEARCH_TIMEOUT_SEC）で、
+    十分な根拠が集まった時点で残りは待たない（結果は後でキャッシュに入る）。
+    """
+    with _lock:
+        _stats["gathers"] += 1
+
+    trivia_terms = _terms(trivia)
+    futures = [
+        _executor.submit(contextvars.copy_context().run, search, query)
+        for query in query_variants(trivia)
+    ]
+
+    evidence = []
+    seen = set()
+    try:
+        for future in as_completed(futures, timeout=SEARCH_TIMEOUT_SEC):
+            try:
+                results = future.result()
+            except Exception as e:
+                with _lock:
+                    _stats["errors"] += 1
+                print(f"search failed: {e}")
+                continue
+
+            for result in results:
+                if result["url"] in seen:
+                    continue
+                seen.add(result["url"])
+                score = relevance(trivia_terms, result["title"] + result["snippet"])
+                if score >= EVIDENCE_MIN_RELEVANCE:
+                    evidence.append({**result, "relevance": score})
+
+            if confidence(evidence) >= EVIDENCE_CONFIDENCE:
+                with _lock:
+                    _stats["early_exits"] += 1
+                break
+    except FuturesTimeoutError:
+        with _lock:
+            _stats["timeouts"] += 1
+
+    evidence.sort(key=lambda e: e["relevance"], reverse=True)
+    return evidence[:EVIDENCE_MAX_SNIPPETS]
+
+
+def format_evidence(evidence: list) -> str:
+    return "\n".join(
+        f"[{i}] {e['title']}：{e['snippet']}"
+        for i, e in enumerate(evidence, start=1)
+    )
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["cache_size"] = len(_cache)
+    snapshot["enabled"] = enabled()
+    return snapshot
@@ -0,0 +1,173 @@
+import os
+import threading
+
+import profileCache
+
+# =====================
+# 設定
+# =====================
+# 押された分をまとめて書き込む間隔
+HEY_FLUSH_MS = int(os.getenv("HEY_FLUSH_MS", "500"))
+# 保存先へ1回で渡す件数の上限（Firestore のバッチ上限に合わせる）
+MAX_BATCH_OPS = 500
+
+_store = None
+_lock = threading.Lock()
+# (id, ver) → まだ書き込んでいない加算分
+_pending = {}
+# (id, ver) → 書き込み中の加算分（書き込みが終わるまで合計に含める）
+_inflight = {}
+_stop = threading.Event()
+_thread = None
+_stats = {
+    "presses": 0,
+    "flushes": 0,
+    "writes": 0,
+    "flush_errors": 0,
+}
+
+
+# =====================
+# 起動・停止
+# =====================
+def start(store):
+    """store は profileStore.ProfileStore（加算の書き込み先）"""
+    global _store, _thread
+    _store = store
+
+    if _thread is None:
+        _stop.clear()
+        _thread = threading.Thread(target=_flush_loop, name="hey-flush", daemon=True)
+        _thread.start()
+
+
+def stop():
+    """フラッシュ用スレッドを止め、残りを書き込む"""
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    flush()
+
+
+def _flush_loop():
+    while not _stop.wait(HEY_FLUSH_MS / 1000):
+        flush()
+
+
+# =====================
+# 読み取り
+# =====================
+def record_totals(profiles) -> dict:
+    """
+    保存先から読んだプロフィールの hey に未書き込み分（書き込み中を含む）を足し、{(id, ver): hey} を返す。
+    """
+    totals = {}
+    with _lock:
+        for profile in profiles:
+            key = (profile.get("id"), profile.get("ver"))
+            totals[key] = (
+                (profile.get("hey", 0) or 0) + _pending.get(key, 0) + _inflight.get(key, 0)
+            )
+            profileCache.set_hey(key[0], key[1], totals[key])
+    return totals
+
+
+def total(user_id: str, ver: int) -> int:
+    hey = profileCache.get_hey(user_id, ver)
+    if hey is not None:
+        return hey
+    # プロフィール全体ではなく、hey の合計だけを読む
+    stored = _store.get_hey_totals([(user_id, ver)])
+    if (user_id, ver) not in stored:
+        return 0
+    return record_totals([{"id": user_id, "ver": ver, "hey": stored[(user_id, ver)]}])[(user_id, ver)]
+
+
+# =====================
+# 加算
+# =====================
+def add(user_id: str, ver: int, delta: int) -> int:
+    """加算をバッファに積み、見込みの合計を返す"""
+    key = (user_id, ver)
+
+    with _lock:
+        hey = profileCache.get_hey(user_id, ver)
+        if hey is not None:
+            return _add_locked(key, hey, delta)
+
+    base = total(user_id, ver)
+    with _lock:
+        hey = profileCache.get_hey(user_id, ver)
+        return _add_locked(key, base if hey is None else hey, delta)
+
+
+def add_many(deltas: dict) -> dict:
+    """{(id, ver): delta} をまとめてバッファに積み、{(id, ver): 見込みの合計} を返す"""
+    return {key: add(key[0], key[1], delta) for key, delta in deltas.items()}
+
+
+def _add_locked(key, hey: int, delta: int) -> int:
+    _pending[key] = _pending.get(key, 0) + delta
+    _stats["presses"] += 1
+    new_hey = hey + delta
+    profileCache.set_hey(key[0], key[1], new_hey)
+    return new_hey
+
+
+# =====================
+# 書き込み
+# =====================
+def flush() -> int:
+    """溜まった加算を保存先へまとめて書き込む（Firestore ではランダムなシャードへ Increment）"""
+    with _lock:
+        items = [(key, delta) for key, delta in _pending.items() if delta]
+        _pending.clear()
+        # 書き込みが終わるまでは、保存先から読んだ値に足す分として残しておく
+        for key, delta in items:
+            _inflight[key] = _inflight.get(key, 0) + delta
+
+    if not items:
+        return 0
+
+    written = 0
+    try:
+        for i in range(0, len(items), MAX_BATCH_OPS):
+            chunk = items[i:i + MAX_BATCH_OPS]
+            _store.increment_hey(dict(chunk))
+            written += len(chunk)
+            with _lock:
+                _settle(chunk)
+    except Exception as e:
+        # 書けなかった分は次回に回す
+        with _lock:
+            rest = items[written:]
+            _settle(rest)
+            for key, delta in rest:
+                _pending[key] = _pending.get(key, 0) + delta
+            _stats["flush_errors"] += 1
+        print(f"hey flush failed: {e}")
+
+    with _lock:
+        _stats["flushes"] += 1
+        _stats["writes"] += written
+    return written
+
+
+def _settle(items: list):
+    """書き込み中の分から外す（_lock を持って呼ぶ）"""
+    for key, delta in items:
+        left = _inflight.get(key, 0) - delta
+        if left:
+            _inflight[key] = left
+        else:
+            _inflight.pop(key, None)
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["pending_keys"] = len(_pending)
+        snapshot["inflight_keys"] = len(_inflight)
+    return snapshot
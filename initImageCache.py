@@ -0,0 +1,205 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# =====================
+# 設定
+# =====================
+# base64 化した画像をメモリに持つ上限（文字数 ≒ バイト数）
+INIT_IMAGE_CACHE_MAX_BYTES = int(os.getenv("INIT_IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# アップロードされた画像の置き場所
+INIT_IMAGE_UPLOAD_DIR = os.getenv("INIT_IMAGE_UPLOAD_DIR", "uploads")
+# アップロード置き場の上限（超えたら古いものから消す）
+INIT_IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("INIT_IMAGE_UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 256 * 1024
+# 何件アップロードされるごとに置き場の掃除をするか
+_PRUNE_EVERY = 32
+
+_lock = threading.Lock()
+# 内容のハッシュ → base64
+_encoded = OrderedDict()
+_encoded_bytes = 0
+# パス → (更新時刻, サイズ, 内容のハッシュ)。ハッシュが LRU から消えたら一緒に消す
+_path_index = {}
+# 内容のハッシュ → そのハッシュを指すパス
+_paths_by_digest = {}
+_uploads_since_prune = 0
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "uploads_pruned": 0,
+}
+
+
+# =====================
+# LRU
+# =====================
+def _get(digest: str) -> str | None:
+    with _lock:
+        encoded = _encoded.get(digest)
+        if encoded is None:
+            _stats["misses"] += 1
+            return None
+        _encoded.move_to_end(digest)
+        _stats["hits"] += 1
+        return encoded
+
+
+def _put(digest: str, encoded: str):
+    global _encoded_bytes
+    with _lock:
+        if digest in _encoded:
+            _encoded.move_to_end(digest)
+            return
+        _encoded[digest] = encoded
+        _encoded_bytes += len(encoded)
+        while _encoded_bytes > INIT_IMAGE_CACHE_MAX_BYTES and len(_encoded) > 1:
+            evicted_digest, evicted = _encoded.popitem(last=False)
+            _encoded_bytes -= len(evicted)
+            _stats["evictions"] += 1
+            for path in _paths_by_digest.pop(evicted_digest, ()):
+                _path_index.pop(path, None)
+
+
+def _index_path(path: str, mtime_ns: int, size: int, digest: str):
+    """_lock を持って呼ぶ"""
+    old = _path_index.get(path)
+    if old is not None:
+        paths = _paths_by_digest.get(old[2])
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del _paths_by_digest[old[2]]
+    _path_index[path] = (mtime_ns, size, digest)
+    _paths_by_digest.setdefault(digest, set()).add(path)
+
+
+# =====================
+# 取得
+# =====================
+def encode_file(path: str) -> str:
+    """
+    ファイルを base64 にして返す。
+    パス・更新時刻・サイズが同じなら読み直さない。
+    """
+    stat = os.stat(path)
+    real_path = os.path.realpath(path)
+
+    with _lock:
+        entry = _path_index.get(real_path)
+    if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+        encoded = _get(entry[2])
+        if encoded is not None:
+            return encoded
+
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    encoded = encode_hashed_file(path, digest, data)
+    with _lock:
+        # LRU に残っているときだけ覚える（消えたハッシュを指す項目を残さない）
+        if digest in _encoded:
+            _index_path(real_path, stat.st_mtime_ns, stat.st_size, digest)
+    return encoded
+
+
+def encode_hashed_file(path: str, digest: str, data: bytes | None = None) -> str:
+    """内容のハッシュが分かっているファイルを base64 にする（キャッシュがあれば読まない）"""
+    encoded = _get(digest)
+    if encoded is not None:
+        return encoded
+
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    encoded = base64.b64encode(data).decode("utf-8")
+    _put(digest, encoded)
+    return encoded
+
+
+# =====================
+# アップロード
+# =====================
+def save_upload(stream) -> tuple[str, str]:
+    """
+    アップロードを少しずつディスクに書きながらハッシュを取り、(パス, ハッシュ) を返す。
+    同じ内容のファイルは1つにまとめる。
+    """
+    os.makedirs(INIT_IMAGE_UPLOAD_DIR, exist_ok=True)
+    hasher = hashlib.sha256()
+
+    fd, tmp_path = tempfile.mkstemp(dir=INIT_IMAGE_UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+
+        digest = hasher.hexdigest()
+        path = os.path.join(INIT_IMAGE_UPLOAD_DIR, digest)
+        # 置き換えで更新時刻も新しくなるので、掃除のときに最近使ったものとして残る
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    global _uploads_since_prune
+    with _lock:
+        _uploads_since_prune += 1
+        due = _uploads_since_prune >= _PRUNE_EVERY
+        if due:
+            _uploads_since_prune = 0
+    if due:
+        prune_uploads(keep=path)
+
+    return path, digest
+
+
+def prune_uploads(keep: str | None = None) -> int:
+    """置き場が INIT_IMAGE_UPLOAD_MAX_BYTES を超えていれば、更新時刻の古いものから消す"""
+    files = []
+    total = 0
+    with os.scandir(INIT_IMAGE_UPLOAD_DIR) as entries:
+        for entry in entries:
+            # 書き込み中の .part は触らない
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+
+    removed = 0
+    files.sort()
+    for _, size, path in files:
+        if total <= INIT_IMAGE_UPLOAD_MAX_BYTES:
+            break
+        if keep is not None and os.path.samefile(path, keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+
+    with _lock:
+        _stats["uploads_pruned"] += removed
+    return removed
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["entries"] = len(_encoded)
+        snapshot["indexed_paths"] = len(_path_index)
+        snapshot["bytes"] = _encoded_bytes
+    return snapshot
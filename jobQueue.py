@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# =====================
+# 設定
+# =====================
+# 同時に処理するジョブ数（SD の GPU 台数に合わせて調整）
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# 完了したジョブ情報を保持する秒数
+JOB_TTL_SEC = int(os.getenv("JOB_TTL_SEC", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# ジョブの状態はこのプロセスのメモリにだけある。
+# uvicorn を複数ワーカーで動かすと /jobs/{id} が別のワーカーに届いて 404 になるので、1ワーカーで動かす
+_jobs = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+
+# =====================
+# ジョブ登録
+# =====================
+def submit(fn, *args, stages=()) -> str:
+    """
+    fn(report, *args) をワーカーで実行するジョブを登録し、ジョブIDを返す。
+    report(stage) を呼ぶと進捗（現在のステージ）が更新される。
+    fn の戻り値（dict）がジョブの結果になる。
+    """
+    _prune()
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _lock:
+        _jobs[job_id] = {
+            "job_id": job_id,
+            "state": QUEUED,
+            "stage": None,
+            "stages": list(stages),
+            "kind": fn.__name__,
+            "result": None,
+            "error": None,
+            # {stage: 秒}（ジョブ中に計った外部呼び出しの内訳）
+            "timings": {},
+            "created_at": now,
+            "updated_at": now,
+        }
+
+    _executor.submit(_run, job_id, fn, args)
+    return job_id
+
+
+def _update(job_id: str, **fields):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job.update(fields)
+        job["updated_at"] = time.time()
+
+
+def _run(job_id: str, fn, args):
+    _update(job_id, state=RUNNING)
+    kind = fn.__name__
+    start = time.perf_counter()
+    current = {"stage": None, "since": start}
+
+    def finish_stage():
+        if current["stage"] is not None:
+            metrics.observe(
+                "job_stage_duration_seconds",
+                time.perf_counter() - current["since"],
+                kind=kind, stage=current["stage"],
+            )
+
+    def report(stage: str):
+        finish_stage()
+        current["stage"] = stage
+        current["since"] = time.perf_counter()
+        _update(job_id, stage=stage)
+
+    token = metrics.begin()
+    try:
+        result = fn(report, *args)
+        fields = {"state": SUCCEEDED, "stage": None, "result": result}
+    except Exception as e:
+        # 失敗したステージは job["stage"] に残る
+        fields = {"state": FAILED, "error": f"{type(e).__name__}: {e}"}
+        metrics.inc(
+            "job_errors_total",
+            kind=kind, stage=current["stage"] or "none", error=type(e).__name__,
+        )
+
+    finish_stage()
+    timings = metrics.end(token)
+    elapsed = time.perf_counter() - start
+    metrics.observe("job_duration_seconds", elapsed, kind=kind)
+    metrics.inc("jobs_total", kind=kind, state=fields["state"])
+    metrics.log_if_slow(f"job {kind} {job_id}", elapsed, timings)
+    _update(job_id, timings=metrics.breakdown(timings), **fields)
+
+
+# =====================
+# 参照
+# =====================
+def get(job_id: str) -> dict | None:
+    """ジョブの状態のコピーを返す（存在しなければ None）"""
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def pending_count() -> int:
+    """待機中・実行中のジョブ数"""
+    with _lock:
+        return sum(1 for j in _jobs.values() if j["state"] in (QUEUED, RUNNING))
+
+
+def progress(job: dict) -> dict:
+    """ステージ一覧に対する進み具合"""
+    stages = job["stages"]
+    total = len(stages)
+    if job["state"] == SUCCEEDED:
+        done = total
+    elif job["stage"] in stages:
+        done = stages.index(job["stage"])
+    else:
+        done = 0
+    return {"done": done, "total": total}
+
+
+def _prune():
+    """TTL を過ぎた完了済みジョブを捨てる"""
+    limit = time.time() - JOB_TTL_SEC
+    with _lock:
+        expired = [
+            job_id for job_id, j in _jobs.items()
+            if j["state"] in (SUCCEEDED, FAILED) and j["updated_at"] < limit
+        ]
+        for job_id in expired:
+            del _jobs[job_id]
+
+
+def shutdown():
+    """待機中のジョブは破棄し、実行中のジョブの完了を待つ"""
+    _executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,249 @@
+import os
+import threading
+from bisect import bisect_left, insort
+
+from referenceData import normalize_date
+
+# =====================
+# 設定
+# =====================
+# 1ランキングあたりに持つ件数
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "100"))
+# 保存先へ書き出す間隔
+LEADERBOARD_CHECKPOINT_SEC = float(os.getenv("LEADERBOARD_CHECKPOINT_SEC", "60"))
+
+# ランキングに載せるカードの項目
+CARD_FIELDS = ("nickname", "trivia", "image_url", "birthplace", "birthday")
+# 出身地別ランキングを作る都道府県（アプリの選択肢と同じ）。これ以外の出身地はランキングを作らない
+PREFECTURES = (
+    "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県",
+    "茨城県", "栃木県", "群馬県", "埼玉県", "千葉県", "東京都", "神奈川県",
+    "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県", "岐阜県",
+    "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県",
+    "奈良県", "和歌山県", "鳥取県", "島根県", "岡山県", "広島県", "山口県",
+    "徳島県", "香川県", "愛媛県", "高知県", "福岡県", "佐賀県", "長崎県",
+    "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県",
+)
+# "東京" のように都・府・県を省いた書き方でも引けるようにする
+_PREFECTURE_INDEX = {
+    **{name[:-1]: name for name in PREFECTURES if name[-1] in "都府県"},
+    **{name: name for name in PREFECTURES},
+}
+
+_store = None
+_lock = threading.Lock()
+# ランキング名 → TopK
+_boards = {}
+# (id, ver) → カードの項目
+_cards = {}
+# 前回の書き出し以降に変わったランキング
+_dirty = set()
+_stop = threading.Event()
+_thread = None
+_stats = {
+    "updates": 0,
+    "changes": 0,
+    "checkpoints": 0,
+    "checkpoint_errors": 0,
+}
+
+
+class TopK:
+    """スコア上位 size 件だけを (-score, key) の昇順で持つ"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.scores = {}
+        self.order = []
+
+    def update(self, key, score: int) -> bool:
+        """key のスコアを score にする。ランキングが変わったら True"""
+        old = self.scores.get(key)
+        if old == score:
+            return False
+        if old is not None:
+            del self.order[bisect_left(self.order, (-old, key))]
+        elif len(self.order) >= self.size and (-score, key) >= self.order[-1]:
+            return False
+
+        insort(self.order, (-score, key))
+        self.scores[key] = score
+        if len(self.order) > self.size:
+            _, evicted = self.order.pop()
+            del self.scores[evicted]
+        return True
+
+    def top(self, limit: int) -> list:
+        return [(key, -negated) for negated, key in self.order[:limit]]
+
+
+# =====================
+# ランキング名
+# =====================
+def birthday_board(value: str) -> str | None:
+    """"1月15日" "1/15" などを "birthday:01/15" にそろえる（日付でなければ None）"""
+    date = normalize_date(value)
+    return f"birthday:{date}" if date else None
+
+
+def birthplace_board(value: str) -> str | None:
+    """"東京都" "東京" を "birthplace:東京都" にそろえる（都道府県でなければ None）"""
+    name = _PREFECTURE_INDEX.get(value.strip())
+    return f"birthplace:{name}" if name else None
+
+
+def normalize_board(name: str) -> str | None:
+    """ランキング名をそろえる（作らないランキングなら None）"""
+    if name == "global":
+        return name
+    kind, _, value = name.partition(":")
+    if kind == "birthday":
+        return birthday_board(value)
+    if kind == "birthplace":
+        return birthplace_board(value)
+    return None
+
+
+def board_names(card: dict) -> list:
+    """全体・出身地別・誕生日別"""
+    names = ["global"]
+    if card.get("birthplace"):
+        name = birthplace_board(str(card["birthplace"]))
+        if name:
+            names.append(name)
+    if card.get("birthday"):
+        name = birthday_board(str(card["birthday"]))
+        if name:
+            names.append(name)
+    return names
+
+
+# =====================
+# 更新
+# =====================
+def record(profile: dict, hey: int):
+    """hey の合計が変わったプロフィールを、そのプロフィールが属するランキングに反映する"""
+    key = (profile.get("id"), profile.get("ver"))
+    card = {field: profile.get(field) for field in CARD_FIELDS}
+
+    with _lock:
+        _stats["updates"] += 1
+        for name in board_names(card):
+            board = _boards.get(name)
+            if board is None:
+                board = _boards[name] = TopK(LEADERBOARD_SIZE)
+            if board.update(key, hey):
+                _stats["changes"] += 1
+                _dirty.add(name)
+                _cards[key] = card
+
+
+def top(name: str, limit: int = LEADERBOARD_SIZE) -> list:
+    with _lock:
+        board = _boards.get(name)
+        if board is None:
+            return []
+        return [
+            {"id": user_id, "ver": ver, "hey": hey, **_cards.get((user_id, ver), {})}
+            for (user_id, ver), hey in board.top(limit)
+        ]
+
+
+# =====================
+# 書き出し・読み込み
+# =====================
+def _merge(name: str, entries: list):
+    """
+    保存先のエントリを取り込む（_lock を持って呼ぶ）。
+    hey は増えるだけなので、同じカードなら大きい方を採る（他のプロセスが書き出した分を消さない）
+    """
+    board = _boards.get(name)
+    if board is None:
+        board = _boards[name] = TopK(LEADERBOARD_SIZE)
+    for entry in entries:
+        key = (entry["id"], entry["ver"])
+        current = board.scores.get(key)
+        if current is not None and current >= entry["hey"]:
+            continue
+        if board.update(key, entry["hey"]):
+            _cards.setdefault(key, {field: entry.get(field) for field in CARD_FIELDS})
+
+
+def _load():
+    boards = _store.load_leaderboards()
+    with _lock:
+        for name, entries in boards.items():
+            # 以前は入力のままの誕生日・出身地で書き出していたので、読み込み時にそろえる
+            normalized = normalize_board(name)
+            if normalized is None:
+                continue
+            if normalized != name:
+                _dirty.add(normalized)
+            _merge(normalized, entries)
+
+
+def checkpoint() -> int:
+    """変わったランキングだけを、保存先の内容と合わせて書き出す"""
+    with _lock:
+        names = list(_dirty)
+        _dirty.clear()
+    if not names:
+        return 0
+
+    try:
+        stored = _store.load_leaderboards(names)
+        with _lock:
+            for name, entries in stored.items():
+                _merge(name, entries)
+        _store.save_leaderboards({name: top(name) for name in names})
+    except Exception as e:
+        with _lock:
+            _dirty.update(names)
+            _stats["checkpoint_errors"] += 1
+        print(f"leaderboard checkpoint failed: {e}")
+        return 0
+
+    with _lock:
+        _stats["checkpoints"] += 1
+        # どのランキングにも残っていないカードは捨てる
+        alive = {key for board in _boards.values() for key in board.scores}
+        for key in [key for key in _cards if key not in alive]:
+            del _cards[key]
+    return len(names)
+
+
+def start(store):
+    global _store, _thread
+    _store = store
+    try:
+        _load()
+    except Exception as e:
+        print(f"leaderboard load failed: {e}")
+
+    if _thread is None:
+        _stop.clear()
+        _thread = threading.Thread(target=_checkpoint_loop, name="leaderboard", daemon=True)
+        _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    checkpoint()
+
+
+def _checkpoint_loop():
+    while not _stop.wait(LEADERBOARD_CHECKPOINT_SEC):
+        checkpoint()
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["boards"] = len(_boards)
+        snapshot["cards"] = len(_cards)
+        snapshot["dirty"] = len(_dirty)
+    return snapshot
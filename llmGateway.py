@@ -0,0 +1,136 @@
+import os
+import random
+import threading
+import time
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+import envConfig  # noqa: F401
+import metrics
+
+# =====================
+# 設定（.env は envConfig がプロセス起動時に1回だけ読む）
+# =====================
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash")
+# 同時に投げてよいリクエスト数
+GEMINI_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "8"))
+# 429 / 5xx のときのリトライ回数
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE_SEC = float(os.getenv("GEMINI_BACKOFF_BASE_SEC", "0.5"))
+GEMINI_BACKOFF_MAX_SEC = float(os.getenv("GEMINI_BACKOFF_MAX_SEC", "8"))
+
+_model = None
+_model_lock = threading.Lock()
+_inflight = threading.BoundedSemaphore(GEMINI_MAX_INFLIGHT)
+
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "errors": 0,
+    "retries": 0,
+    "latency_sec_total": 0.0,
+    "latency_sec_max": 0.0,
+    "prompt_tokens": 0,
+    "output_tokens": 0,
+    "total_tokens": 0,
+}
+
+
+# =====================
+# モデル（プロセスで1つだけ作る）
+# =====================
+def get_model():
+    global _model
+    if _model is not None:
+        return _model
+
+    with _model_lock:
+        if _model is None:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                raise RuntimeError("GEMINI_API_KEY is not set")
+
+            genai.configure(api_key=api_key)
+            _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
+
+
+def set_model(model):
+    """テストやベンチマーク用にモデルを差し替える"""
+    global _model
+    with _model_lock:
+        _model = model
+
+
+# =====================
+# 呼び出し
+# =====================
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, google_exceptions.GoogleAPICallError):
+        code = e.code
+        return code == 429 or (isinstance(code, int) and 500 <= code < 600)
+    return isinstance(e, (google_exceptions.RetryError, TimeoutError, ConnectionError))
+
+
+def _backoff(attempt: int) -> float:
+    # full jitter
+    cap = min(GEMINI_BACKOFF_MAX_SEC, GEMINI_BACKOFF_BASE_SEC * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _record(latency: float, response=None, failed: bool = False):
+    usage = getattr(response, "usage_metadata", None)
+    with _stats_lock:
+        _stats["calls"] += 1
+        if failed:
+            _stats["errors"] += 1
+        _stats["latency_sec_total"] += latency
+        _stats["latency_sec_max"] = max(_stats["latency_sec_max"], latency)
+        if usage is not None:
+            _stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+            _stats["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+            _stats["total_tokens"] += getattr(usage, "total_token_count", 0) or 0
+
+
+def generate(prompt, **kwargs):
+    """
+    model.generate_content のラッパー。
+    同時実行数を制限し、429 / 5xx はジッター付き指数バックオフで再試行する。
+    """
+    model = get_model()
+
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            with _inflight, metrics.timer("gemini"):
+                response = model.generate_content(prompt, **kwargs)
+        except Exception as e:
+            _record(time.perf_counter() - start, failed=True)
+            if attempt >= GEMINI_MAX_RETRIES or not _is_retryable(e):
+                raise
+            with _stats_lock:
+                _stats["retries"] += 1
+            time.sleep(_backoff(attempt))
+            attempt += 1
+            continue
+
+        _record(time.perf_counter() - start, response)
+        return response
+
+
+def generate_text(prompt, **kwargs) -> str:
+    return generate(prompt, **kwargs).text.strip()
+
+
+# =====================
+# 統計
+# =====================
+def stats() -> dict:
+    with _stats_lock:
+        snapshot = dict(_stats)
+    calls = snapshot["calls"]
+    snapshot["latency_sec_avg"] = snapshot["latency_sec_total"] / calls if calls else 0.0
+    snapshot["max_inflight"] = GEMINI_MAX_INFLIGHT
+    return snapshot
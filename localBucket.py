@@ -0,0 +1,53 @@
+import os
+import shutil
+from urllib.parse import quote
+
+# =====================
+# Firebase Storage の代わりにローカルのディレクトリへ置く
+# （apiResponse で使う blob の操作だけを持つ）
+# =====================
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, *name.split("/"))
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None, predefined_acl=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "wb") as out:
+            shutil.copyfileobj(file_obj, out)
+        os.replace(tmp_path, self.path)
+
+    def upload_from_string(self, data, content_type=None, predefined_acl=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "wb") as out:
+            out.write(data)
+        os.replace(tmp_path, self.path)
+
+    def make_public(self):
+        pass
+
+    @property
+    def public_url(self) -> str:
+        return self.bucket.base_url.rstrip("/") + "/" + quote(self.name)
+
+
+class LocalBucket:
+
+    def __init__(self, root: str, base_url: str):
+        self.root = root
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
@@ -0,0 +1,225 @@
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# =====================
+# 設定
+# =====================
+# これより遅いリクエスト・ジョブはステージの内訳をログに出す（0 で無効）
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+# ヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+# name → (種類, 説明)
+_meta = {}
+# (name, ラベル) → 値
+_counters = {}
+_gauges = {}
+# (name, ラベル) → [区切りごとの件数..., 合計, 件数]
+_histograms = {}
+
+# リクエスト（またはジョブ）中に計ったステージの [(stage, 秒)]
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def describe(name: str, kind: str, text: str):
+    _meta[name] = (kind, text)
+
+
+describe("http_requests_total", "counter", "HTTP リクエスト数")
+describe("http_request_duration_seconds", "histogram", "HTTP リクエストの処理時間")
+describe("http_requests_in_flight", "gauge", "処理中の HTTP リクエスト数")
+describe("stage_duration_seconds", "histogram", "外部呼び出し・処理ステージごとの所要時間")
+describe("stage_in_flight", "gauge", "実行中のステージ数")
+describe("stage_errors_total", "counter", "ステージごとの例外数")
+describe("job_duration_seconds", "histogram", "ジョブの所要時間")
+describe("job_stage_duration_seconds", "histogram", "ジョブの各ステージの所要時間")
+describe("jobs_total", "counter", "終了したジョブ数")
+describe("job_errors_total", "counter", "失敗したジョブ数（失敗したステージごと）")
+describe("job_queue_depth", "gauge", "待機中・実行中のジョブ数")
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+# =====================
+# 記録
+# =====================
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge_add(name: str, delta: float, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def gauge_set(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    with metrics.timer("gemini"): ... の所要時間・実行中の数・例外数を記録する。
+    リクエストやジョブの中なら Server-Timing / 遅いリクエストのログにも載る。
+    """
+    gauge_add("stage_in_flight", 1, stage=stage)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        inc("stage_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        gauge_add("stage_in_flight", -1, stage=stage)
+        observe("stage_duration_seconds", elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def timed(stage: str):
+    """関数全体を timer で囲むデコレータ（async 関数にも使える）"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Instrumented:
+    """公開メソッドの呼び出しを "{prefix}.{メソッド名}" のステージとして計る"""
+
+    def __init__(self, target, prefix: str):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return timed(f"{self._prefix}.{name}")(attr)
+
+
+def instrument(target, prefix: str):
+    return _Instrumented(target, prefix)
+
+
+# =====================
+# リクエスト・ジョブ単位の内訳
+# =====================
+def begin():
+    """以降のステージをこのコンテキストで集める。end(token) と対で使う"""
+    return _timings.set([])
+
+
+def end(token) -> list:
+    timings = _timings.get() or []
+    _timings.reset(token)
+    return timings
+
+
+def breakdown(timings: list) -> dict:
+    """{stage: 合計秒}（出てきた順）"""
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return totals
+
+
+def server_timing(timings: list, total_sec: float) -> str:
+    parts = [
+        f"{stage};dur={elapsed * 1000:.1f}"
+        for stage, elapsed in breakdown(timings).items()
+    ]
+    parts.append(f"total;dur={total_sec * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def log_if_slow(label: str, total_sec: float, timings: list):
+    if SLOW_REQUEST_MS <= 0 or total_sec * 1000 < SLOW_REQUEST_MS:
+        return
+    detail = " ".join(
+        f"{stage}={elapsed * 1000:.0f}ms"
+        for stage, elapsed in breakdown(timings).items()
+    )
+    print(f"slow: {label} {total_sec * 1000:.0f}ms {detail}")
+
+
+# =====================
+# Prometheus 形式
+# =====================
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+
+    by_name = {}
+    for (name, labels), value in sorted(counters.items()):
+        by_name.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        by_name.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), values in sorted(histograms.items()):
+        lines = by_name.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(DEFAULT_BUCKETS, values):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {values[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+
+    out = []
+    for name in sorted(by_name):
+        kind, text = _meta.get(name, ("untyped", ""))
+        out.append(f"# HELP {name} {text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(by_name[name])
+    return "\n".join(out) + "\n"
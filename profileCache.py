@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# =====================
+# 設定
+# =====================
+# (id, ver) のプロフィールはほぼ変わらないので長く持てる
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "5000"))
+# 別プロセスでの書き換え（back/reverify.py など）を拾うまでの上限（0 で期限なし）
+PROFILE_CACHE_TTL_SEC = float(os.getenv("PROFILE_CACHE_TTL_SEC", "300"))
+# hey だけは変わるので短い期限で持つ
+HEY_CACHE_TTL_SEC = float(os.getenv("HEY_CACHE_TTL_SEC", "10"))
+
+_lock = threading.Lock()
+_profiles = OrderedDict()
+_hey = {}
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "hey_hits": 0,
+    "hey_misses": 0,
+}
+
+
+# =====================
+# 変わらない部分
+# =====================
+def get(user_id: str, ver: int) -> dict | None:
+    key = (user_id, ver)
+    with _lock:
+        entry = _profiles.get(key)
+        if entry is None or (
+            PROFILE_CACHE_TTL_SEC > 0 and entry[1] < time.monotonic() - PROFILE_CACHE_TTL_SEC
+        ):
+            _stats["misses"] += 1
+            return None
+        _profiles.move_to_end(key)
+        _stats["hits"] += 1
+        return entry[0]
+
+
+def put(user_id: str, ver: int, payload: dict):
+    """payload は JSON 化済みで、以後書き換えないこと"""
+    key = (user_id, ver)
+    with _lock:
+        _profiles[key] = (payload, time.monotonic())
+        _profiles.move_to_end(key)
+        while len(_profiles) > PROFILE_CACHE_SIZE:
+            _profiles.popitem(last=False)
+
+
+def invalidate(user_id: str, ver: int):
+    """画像の再生成などで内容が変わったときに捨てる"""
+    with _lock:
+        _profiles.pop((user_id, ver), None)
+
+
+# =====================
+# hey
+# =====================
+def get_hey(user_id: str, ver: int) -> int | None:
+    key = (user_id, ver)
+    with _lock:
+        entry = _hey.get(key)
+        if entry is None or entry[1] < time.monotonic() - HEY_CACHE_TTL_SEC:
+            _stats["hey_misses"] += 1
+            return None
+        _stats["hey_hits"] += 1
+        return entry[0]
+
+
+def set_hey(user_id: str, ver: int, hey: int):
+    key = (user_id, ver)
+    with _lock:
+        _hey[key] = (hey, time.monotonic())
+        # プロフィールを追い出したものは hey も捨てる
+        if len(_hey) > PROFILE_CACHE_SIZE:
+            for stale in [k for k in _hey if k not in _profiles]:
+                del _hey[stale]
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["size"] = len(_profiles)
+    return snapshot
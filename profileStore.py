@@ -0,0 +1,1035 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
+
+# =====================
+# 設定
+# =====================
+PROFILE_COLLECTION = "p2hacks2025"
+# get_all 1回あたりの件数と、並列に投げる数
+GET_ALL_CHUNK_SIZE = int(os.getenv("GET_ALL_CHUNK_SIZE", "100"))
+GET_ALL_PARALLELISM = int(os.getenv("GET_ALL_PARALLELISM", "8"))
+# 1プロフィールあたりの hey カウンタ分割数（書き込みの競合を避ける）
+HEY_SHARDS = int(os.getenv("HEY_SHARDS", "8"))
+SHARD_COLLECTION = "hey_shards"
+# バッチ1回あたりの操作数の上限
+MAX_BATCH_OPS = 500
+# 移行前の自動IDドキュメントを探すか（back/firebase/migrate_doc_ids.py を流し終えたら 0 にする）
+LEGACY_DOC_LOOKUP = os.getenv("LEGACY_DOC_LOOKUP", "1") != "0"
+# Firestore の "in" に渡せる値の上限
+MAX_IN_VALUES = 30
+# ドキュメント側の hey（移行前の値）を覚えておく件数（hey だけを読み直すときに使う）
+HEY_BASE_CACHE_SIZE = 100000
+# すれ違いの受信箱：encounter_inbox/{observer}/inbox_cards/{peer の doc_id}
+INBOX_COLLECTION = "encounter_inbox"
+INBOX_ITEMS = "inbox_cards"
+# Firestore の受信箱は、これより新しい seq を読まない（書き込み中の seq を飛ばさないため）
+INBOX_COMMIT_LAG_MS = int(os.getenv("INBOX_COMMIT_LAG_MS", "2000"))
+# ランキングの書き出し先（1ランキング1ドキュメント）
+LEADERBOARD_COLLECTION = "leaderboards"
+
+_seq_lock = threading.Lock()
+_last_seq = 0
+
+
+def profile_doc_id(user_id: str, ver: int) -> str:
+    """(id, ver) から決まるドキュメントID"""
+    return f"{user_id}_v{ver}"
+
+
+def next_seq() -> int:
+    """受信箱のカーソルに使う単調増加の番号（時刻のナノ秒）"""
+    global _last_seq
+    with _seq_lock:
+        _last_seq = max(_last_seq + 1, time.time_ns())
+        return _last_seq
+
+
+# =====================
+# 共通インターフェース
+# =====================
+class ProfileStore:
+    """
+    プロフィールの保存先。
+    返すプロフィールは保存したフィールド + "doc_id" + "hey"（合計値）。
+    """
+
+    def get_profile(self, user_id: str, ver: int) -> dict | None:
+        raise NotImplementedError
+
+    def get_profiles(self, keys: list) -> dict:
+        """{(id, ver): profile}。見つからないものは含まない"""
+        raise NotImplementedError
+
+    def create_profile(self, data: dict):
+        """data["id"], data["ver"] のプロフィールを保存する（既存のフィールドには上書きでマージ）"""
+        raise NotImplementedError
+
+    def update_profile(self, user_id: str, ver: int, fields: dict):
+        raise NotImplementedError
+
+    def increment_hey(self, deltas: dict):
+        """{(id, ver): delta} をまとめて加算する"""
+        raise NotImplementedError
+
+    def get_hey_totals(self, keys: list) -> dict:
+        """{(id, ver): hey}。プロフィールはキャッシュにあり、hey だけを読み直すとき用"""
+        return {key: profile["hey"] for key, profile in self.get_profiles(keys).items()}
+
+    def list_profiles(self, filters: dict | None = None, limit: int | None = None) -> list:
+        """filters のフィールドが一致するプロフィール（hey は含まない）"""
+        raise NotImplementedError
+
+    def scan_profiles(self, after: str | None, limit: int) -> list:
+        """doc_id の昇順で after より後を limit 件（hey は含まない）。全件を順に読む用"""
+        raise NotImplementedError
+
+    def update_profiles(self, updates: dict) -> list:
+        """
+        {doc_id: fields} をまとめて更新し、更新できなかった doc_id を返す。
+        doc_id で書くので、移行前の自動IDドキュメントもそのまま更新できる
+        """
+        raise NotImplementedError
+
+    # ---------- すれ違いの受信箱 ----------
+    def add_encounters(self, observer: str, encounters: dict) -> int:
+        """
+        {(peer_id, peer_ver): seen_at(ms)} を observer の受信箱に書き込む。
+        既にあるものは回数・最終日時を更新し、カーソルを進める。書き込んだカーソルを返す。
+        """
+        raise NotImplementedError
+
+    def read_inbox(self, observer: str, since: int, limit: int) -> list:
+        """カーソル since より後の受信箱の項目（seq の昇順）"""
+        raise NotImplementedError
+
+    def touch_encounters(self, peer_id: str, peer_ver: int) -> int:
+        """カードが変わったとき、それを持つ全員の受信箱でカーソルを進める。更新数を返す"""
+        raise NotImplementedError
+
+    # ---------- ランキング ----------
+    def save_leaderboards(self, boards: dict):
+        """{ランキング名: [エントリ]} を上書き保存する"""
+        raise NotImplementedError
+
+    def load_leaderboards(self, names: list | None = None) -> dict:
+        """{ランキング名: [エントリ]}。names を渡せばそのランキングだけ"""
+        raise NotImplementedError
+
+    # 非同期版（async のエンドポイント用）。既定ではスレッドで同期版を呼ぶ
+    async def aget_profile(self, user_id: str, ver: int) -> dict | None:
+        return await asyncio.to_thread(self.get_profile, user_id, ver)
+
+    async def aget_profiles(self, keys: list) -> dict:
+        return await asyncio.to_thread(self.get_profiles, keys)
+
+    async def aget_hey_totals(self, keys: list) -> dict:
+        return await asyncio.to_thread(self.get_hey_totals, keys)
+
+    async def aadd_encounters(self, observer: str, encounters: dict) -> int:
+        return await asyncio.to_thread(self.add_encounters, observer, encounters)
+
+    async def aread_inbox(self, observer: str, since: int, limit: int) -> list:
+        return await asyncio.to_thread(self.read_inbox, observer, since, limit)
+
+
+# =====================
+# Firestore
+# =====================
+class FirestoreProfileStore(ProfileStore):
+    """読み取りの非同期版は async_db（firestore.AsyncClient）を使う"""
+
+    def __init__(self, db, async_db=None):
+        self.db = db
+        self.async_db = async_db
+        self._executor = ThreadPoolExecutor(
+            max_workers=GET_ALL_PARALLELISM, thread_name_prefix="firestore"
+        )
+        # このプロセスで書き込み中の受信箱の seq（の最小値）
+        self._open_lock = threading.Lock()
+        self._open_seqs = {}
+        # (id, ver) → ドキュメント側の hey。シャードだけを読めば合計が出せるようにする
+        self._base_lock = threading.Lock()
+        self._hey_base = OrderedDict()
+
+    def ref(self, user_id: str, ver: int):
+        return self.db.collection(PROFILE_COLLECTION).document(profile_doc_id(user_id, ver))
+
+    def _shard_refs(self, user_id: str, ver: int) -> list:
+        collection = self.ref(user_id, ver).collection(SHARD_COLLECTION)
+        return [collection.document(shard_id) for shard_id in self._shard_ids()]
+
+    @staticmethod
+    def _shard_ids() -> list:
+        return [str(i) for i in range(HEY_SHARDS)]
+
+    def _get_all(self, refs: list) -> list:
+        """get_all を分割し、複数チャンクなら並列に投げる"""
+        chunks = [
+            refs[i:i + GET_ALL_CHUNK_SIZE]
+            for i in range(0, len(refs), GET_ALL_CHUNK_SIZE)
+        ]
+        if len(chunks) <= 1:
+            return [snap for chunk in chunks for snap in self.db.get_all(chunk)]
+
+        results = self._executor.map(lambda chunk: list(self.db.get_all(chunk)), chunks)
+        return [snap for snaps in results for snap in snaps]
+
+    def _with_hey(self, snapshots) -> list:
+        """ドキュメントの hey（移行前の値）に各シャードを足す"""
+        profiles = []
+        owners = {}
+        refs = []
+        for snapshot in snapshots:
+            data = snapshot.to_dict()
+            data["doc_id"] = snapshot.id
+            data["hey"] = data.get("hey", 0) or 0
+            self._remember_base((data.get("id"), data.get("ver")), data["hey"])
+            profiles.append(data)
+            for ref in self._shard_refs(data.get("id"), data.get("ver")):
+                owners[ref.path] = data
+                refs.append(ref)
+
+        for shard in self._get_all(refs):
+            if shard.exists:
+                owners[shard.reference.path]["hey"] += shard.to_dict().get("count", 0) or 0
+        return profiles
+
+    def _remember_base(self, key: tuple, base: int):
+        with self._base_lock:
+            self._hey_base[key] = base
+            self._hey_base.move_to_end(key)
+            while len(self._hey_base) > HEY_BASE_CACHE_SIZE:
+                self._hey_base.popitem(last=False)
+
+    def _known_bases(self, keys: list) -> tuple:
+        """({(id, ver): ドキュメント側の hey}, ドキュメント側の hey を覚えていない keys)"""
+        known = {}
+        unknown = []
+        with self._base_lock:
+            for key in keys:
+                if key in self._hey_base:
+                    known[key] = self._hey_base[key]
+                else:
+                    unknown.append(key)
+        return known, unknown
+
+    @staticmethod
+    def _add_shards(totals: dict, owners: dict, shards):
+        for shard in shards:
+            if shard.exists:
+                totals[owners[shard.reference.path]] += shard.to_dict().get("count", 0) or 0
+
+    def get_hey_totals(self, keys: list) -> dict:
+        """ドキュメント側の hey を覚えていれば、シャードだけを読んで足す"""
+        totals, unknown = self._known_bases(keys)
+        owners = {}
+        refs = []
+        for key in totals:
+            for ref in self._shard_refs(*key):
+                owners[ref.path] = key
+                refs.append(ref)
+        self._add_shards(totals, owners, self._get_all(refs))
+
+        for key, profile in (self.get_profiles(unknown) if unknown else {}).items():
+            totals[key] = profile["hey"]
+        return totals
+
+    def _find_legacy(self, key: tuple):
+        """移行前の自動IDドキュメントはクエリで探す"""
+        found = self._find_legacy_many([key])
+        return found[0] if found else None
+
+    @staticmethod
+    def _legacy_groups(keys: list) -> list:
+        """[(ver, [id, ...])]。ver ごとに id を "in" の上限ずつにまとめる"""
+        by_ver = {}
+        for user_id, ver in keys:
+            by_ver.setdefault(ver, []).append(user_id)
+        return [
+            (ver, ids[i:i + MAX_IN_VALUES])
+            for ver, ids in by_ver.items()
+            for i in range(0, len(ids), MAX_IN_VALUES)
+        ]
+
+    @staticmethod
+    def _first_per_key(docs: list) -> list:
+        """同じ (id, ver) が複数あれば1件だけ残す"""
+        unique = {}
+        for doc in docs:
+            data = doc.to_dict()
+            unique.setdefault((data.get("id"), data.get("ver")), doc)
+        return list(unique.values())
+
+    def _legacy_query(self, group: tuple) -> list:
+        ver, ids = group
+        query = (
+            self.db.collection(PROFILE_COLLECTION)
+            .where("ver", "==", ver)
+            .where("id", "in", ids)
+        )
+        return list(query.stream())
+
+    def _find_legacy_many(self, keys: list) -> list:
+        """keys の移行前ドキュメントを、ver ごとの "in" クエリでまとめて探す"""
+        if not LEGACY_DOC_LOOKUP or not keys:
+            return []
+        groups = self._legacy_groups(keys)
+        if len(groups) == 1:
+            return self._first_per_key(self._legacy_query(groups[0]))
+        results = self._executor.map(self._legacy_query, groups)
+        return self._first_per_key([doc for docs in results for doc in docs])
+
+    def get_profile(self, user_id: str, ver: int) -> dict | None:
+        snapshot = self.ref(user_id, ver).get()
+        if not snapshot.exists:
+            snapshot = self._find_legacy((user_id, ver))
+            if snapshot is None:
+                return None
+        return self._with_hey([snapshot])[0]
+
+    def get_profiles(self, keys: list) -> dict:
+        refs = [self.ref(user_id, ver) for user_id, ver in keys]
+        snapshots = [snap for snap in self._get_all(refs) if snap.exists]
+
+        # 見つからなかったものは get_profile と同じく移行前のドキュメントを探す
+        found = {snap.id for snap in snapshots}
+        missing = [key for key in keys if profile_doc_id(*key) not in found]
+        snapshots += self._find_legacy_many(missing)
+
+        return {
+            (profile.get("id"), profile.get("ver")): profile
+            for profile in self._with_hey(snapshots)
+        }
+
+    # ---------- 非同期版 ----------
+    def _async_ref(self, user_id: str, ver: int):
+        return self.async_db.collection(PROFILE_COLLECTION).document(profile_doc_id(user_id, ver))
+
+    async def _aget_all(self, refs: list) -> list:
+        async def fetch(chunk):
+            return [snap async for snap in self.async_db.get_all(chunk)]
+
+        chunks = [
+            refs[i:i + GET_ALL_CHUNK_SIZE]
+            for i in range(0, len(refs), GET_ALL_CHUNK_SIZE)
+        ]
+        results = await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+        return [snap for snaps in results for snap in snaps]
+
+    async def _awith_hey(self, snapshots) -> list:
+        profiles = []
+        owners = {}
+        refs = []
+        for snapshot in snapshots:
+            data = snapshot.to_dict()
+            data["doc_id"] = snapshot.id
+            data["hey"] = data.get("hey", 0) or 0
+            self._remember_base((data.get("id"), data.get("ver")), data["hey"])
+            profiles.append(data)
+            collection = self._async_ref(data.get("id"), data.get("ver")).collection(SHARD_COLLECTION)
+            for shard_id in self._shard_ids():
+                ref = collection.document(shard_id)
+                owners[ref.path] = data
+                refs.append(ref)
+
+        for shard in await self._aget_all(refs):
+            if shard.exists:
+                owners[shard.reference.path]["hey"] += shard.to_dict().get("count", 0) or 0
+        return profiles
+
+    async def aget_profile(self, user_id: str, ver: int) -> dict | None:
+        if self.async_db is None:
+            return await super().aget_profile(user_id, ver)
+
+        snapshot = await self._async_ref(user_id, ver).get()
+        if not snapshot.exists:
+            snapshot = await self._afind_legacy((user_id, ver))
+            if snapshot is None:
+                return None
+        return (await self._awith_hey([snapshot]))[0]
+
+    async def aget_hey_totals(self, keys: list) -> dict:
+        if self.async_db is None:
+            return await super().aget_hey_totals(keys)
+
+        totals, unknown = self._known_bases(keys)
+        owners = {}
+        refs = []
+        for key in totals:
+            collection = self._async_ref(*key).collection(SHARD_COLLECTION)
+            for shard_id in self._shard_ids():
+                ref = collection.document(shard_id)
+                owners[ref.path] = key
+                refs.append(ref)
+        self._add_shards(totals, owners, await self._aget_all(refs))
+
+        for key, profile in (await self.aget_profiles(unknown) if unknown else {}).items():
+            totals[key] = profile["hey"]
+        return totals
+
+    async def _afind_legacy(self, key: tuple):
+        found = await self._afind_legacy_many([key])
+        return found[0] if found else None
+
+    async def _afind_legacy_many(self, keys: list) -> list:
+        if not LEGACY_DOC_LOOKUP or not keys:
+            return []
+
+        async def fetch(group):
+            ver, ids = group
+            query = (
+                self.async_db.collection(PROFILE_COLLECTION)
+                .where("ver", "==", ver)
+                .where("id", "in", ids)
+            )
+            return [doc async for doc in query.stream()]
+
+        results = await asyncio.gather(*(fetch(group) for group in self._legacy_groups(keys)))
+        return self._first_per_key([doc for docs in results for doc in docs])
+
+    async def aget_profiles(self, keys: list) -> dict:
+        if self.async_db is None:
+            return await super().aget_profiles(keys)
+
+        refs = [self._async_ref(user_id, ver) for user_id, ver in keys]
+        snapshots = [snap for snap in await self._aget_all(refs) if snap.exists]
+
+        found = {snap.id for snap in snapshots}
+        missing = [key for key in keys if profile_doc_id(*key) not in found]
+        snapshots += await self._afind_legacy_many(missing)
+
+        return {
+            (profile.get("id"), profile.get("ver")): profile
+            for profile in await self._awith_hey(snapshots)
+        }
+
+    # ---------- 書き込み ----------
+    def create_profile(self, data: dict):
+        self.ref(data["id"], data["ver"]).set(data, merge=True)
+
+    def update_profile(self, user_id: str, ver: int, fields: dict):
+        self.ref(user_id, ver).update(fields)
+
+    def increment_hey(self, deltas: dict):
+        from google.cloud.firestore import Increment
+
+        items = [(key, delta) for key, delta in deltas.items() if delta]
+        for i in range(0, len(items), MAX_BATCH_OPS):
+            batch = self.db.batch()
+            for (user_id, ver), delta in items[i:i + MAX_BATCH_OPS]:
+                shard = random.choice(self._shard_refs(user_id, ver))
+                batch.set(shard, {"count": Increment(delta)}, merge=True)
+            batch.commit()
+
+    def list_profiles(self, filters: dict | None = None, limit: int | None = None) -> list:
+        query = self.db.collection(PROFILE_COLLECTION)
+        for field, value in (filters or {}).items():
+            query = query.where(field, "==", value)
+        if limit is not None:
+            query = query.limit(limit)
+
+        return self._stream_profiles(query)
+
+    @staticmethod
+    def _stream_profiles(query) -> list:
+        profiles = []
+        for snapshot in query.stream():
+            data = snapshot.to_dict()
+            data.pop("hey", None)
+            data["doc_id"] = snapshot.id
+            profiles.append(data)
+        return profiles
+
+    def scan_profiles(self, after: str | None, limit: int) -> list:
+        from google.cloud.firestore import FieldPath
+
+        collection = self.db.collection(PROFILE_COLLECTION)
+        query = collection.order_by(FieldPath.document_id())
+        if after is not None:
+            query = query.where(FieldPath.document_id(), ">", collection.document(after))
+        return self._stream_profiles(query.limit(limit))
+
+    def update_profiles(self, updates: dict) -> list:
+        collection = self.db.collection(PROFILE_COLLECTION)
+        items = list(updates.items())
+        failed = []
+        for i in range(0, len(items), MAX_BATCH_OPS):
+            chunk = items[i:i + MAX_BATCH_OPS]
+            batch = self.db.batch()
+            for doc_id, fields in chunk:
+                batch.update(collection.document(doc_id), fields)
+            try:
+                batch.commit()
+                continue
+            except Exception as e:
+                print(f"batch update failed, retrying one by one: {e}")
+
+            # 1件の失敗（消されたドキュメントなど）でほかを巻き込まない
+            for doc_id, fields in chunk:
+                try:
+                    collection.document(doc_id).update(fields)
+                except Exception as e:
+                    print(f"update failed: {doc_id}: {e}")
+                    failed.append(doc_id)
+        return failed
+
+    # ---------- すれ違いの受信箱 ----------
+    def _inbox(self, observer: str):
+        return self.db.collection(INBOX_COLLECTION).document(observer).collection(INBOX_ITEMS)
+
+    @staticmethod
+    def _inbox_entry(snapshot) -> dict:
+        data = snapshot.to_dict()
+        return {
+            "peer_id": data.get("peer_id"),
+            "peer_ver": data.get("peer_ver"),
+            "seen_at": data.get("seen_at"),
+            "count": data.get("count", 0),
+            "seq": data.get("seq"),
+        }
+
+    def _safe_seq(self) -> int:
+        """
+        これ以下の seq は書き込み済みとみなせる上限。
+        このプロセスの書き込み中のものは確実に、他のインスタンスの分は INBOX_COMMIT_LAG_MS で守る
+        """
+        safe = time.time_ns() - INBOX_COMMIT_LAG_MS * 1_000_000
+        with self._open_lock:
+            if self._open_seqs:
+                safe = min(safe, min(self._open_seqs.values()) - 1)
+        return safe
+
+    def _commit_with_seq(self, writes: list) -> int:
+        """
+        writes は [(ref, fields)]。seq を振ってマージで書き、最後の seq を返す。
+        コミットが INBOX_COMMIT_LAG_MS より遅れたものは、読み飛ばされないよう seq を振り直す。
+        """
+        seq = 0
+        for i in range(0, len(writes), MAX_BATCH_OPS):
+            chunk = writes[i:i + MAX_BATCH_OPS]
+            while True:
+                token = object()
+                with self._open_lock:
+                    seqs = [next_seq() for _ in chunk]
+                    self._open_seqs[token] = seqs[0]
+                try:
+                    batch = self.db.batch()
+                    for (ref, fields), seq in zip(chunk, seqs):
+                        batch.set(ref, {**fields, "seq": seq}, merge=True)
+                    batch.commit()
+                finally:
+                    with self._open_lock:
+                        del self._open_seqs[token]
+
+                if time.time_ns() - seqs[0] <= INBOX_COMMIT_LAG_MS * 1_000_000:
+                    break
+                # 振り直すのは seq だけ（count などを二重に足さない）
+                chunk = [(ref, {}) for ref, _ in chunk]
+        return seq
+
+    def add_encounters(self, observer: str, encounters: dict) -> int:
+        from google.cloud.firestore import Increment
+
+        inbox = self._inbox(observer)
+        return self._commit_with_seq([
+            (inbox.document(profile_doc_id(peer_id, peer_ver)), {
+                "peer_id": peer_id,
+                "peer_ver": peer_ver,
+                "seen_at": seen_at,
+                "count": Increment(1),
+            })
+            for (peer_id, peer_ver), seen_at in encounters.items()
+        ])
+
+    def read_inbox(self, observer: str, since: int, limit: int) -> list:
+        query = (
+            self._inbox(observer)
+            .where("seq", ">", since)
+            .where("seq", "<=", self._safe_seq())
+            .order_by("seq")
+            .limit(limit)
+        )
+        return [self._inbox_entry(snapshot) for snapshot in query.stream()]
+
+    async def aread_inbox(self, observer: str, since: int, limit: int) -> list:
+        if self.async_db is None:
+            return await super().aread_inbox(observer, since, limit)
+
+        query = (
+            self.async_db.collection(INBOX_COLLECTION).document(observer)
+            .collection(INBOX_ITEMS)
+            .where("seq", ">", since)
+            .where("seq", "<=", self._safe_seq())
+            .order_by("seq")
+            .limit(limit)
+        )
+        return [self._inbox_entry(snapshot) async for snapshot in query.stream()]
+
+    def touch_encounters(self, peer_id: str, peer_ver: int) -> int:
+        # コレクショングループの (peer_id, peer_ver) インデックスが必要
+        query = (
+            self.db.collection_group(INBOX_ITEMS)
+            .where("peer_id", "==", peer_id)
+            .where("peer_ver", "==", peer_ver)
+        )
+        refs = [snapshot.reference for snapshot in query.stream()]
+        self._commit_with_seq([(ref, {}) for ref in refs])
+        return len(refs)
+
+    # ---------- ランキング ----------
+    def save_leaderboards(self, boards: dict):
+        collection = self.db.collection(LEADERBOARD_COLLECTION)
+        items = list(boards.items())
+        for i in range(0, len(items), MAX_BATCH_OPS):
+            batch = self.db.batch()
+            for name, entries in items[i:i + MAX_BATCH_OPS]:
+                # "birthday:01/01" の "/" はドキュメントIDに使えない
+                doc_id = quote(name, safe="")
+                batch.set(collection.document(doc_id), {
+                    "name": name,
+                    "entries": entries,
+                    "updated_at": datetime.datetime.now(),
+                })
+            batch.commit()
+
+    def load_leaderboards(self, names: list | None = None) -> dict:
+        collection = self.db.collection(LEADERBOARD_COLLECTION)
+        if names is None:
+            snapshots = collection.stream()
+        else:
+            snapshots = self._get_all([collection.document(quote(name, safe="")) for name in names])
+
+        boards = {}
+        for snapshot in snapshots:
+            if not snapshot.exists:
+                continue
+            data = snapshot.to_dict()
+            boards[data["name"]] = data.get("entries", [])
+        return boards
+
+
+# =====================
+# SQLite（ローカルでの計測・負荷試験用）
+# =====================
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class SQLiteProfileStore(ProfileStore):
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS profiles (
+                doc_id TEXT PRIMARY KEY,
+                id TEXT NOT NULL,
+                ver INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                hey INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS profiles_id_ver ON profiles (id, ver)"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS inbox (
+                observer TEXT NOT NULL,
+                peer_id TEXT NOT NULL,
+                peer_ver INTEGER NOT NULL,
+                seen_at INTEGER,
+                count INTEGER NOT NULL DEFAULT 0,
+                seq INTEGER NOT NULL,
+                PRIMARY KEY (observer, peer_id, peer_ver)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS inbox_seq ON inbox (observer, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS inbox_peer ON inbox (peer_id, peer_ver)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leaderboards (
+                name TEXT PRIMARY KEY,
+                entries TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _row_to_profile(row) -> dict:
+        doc_id, data, hey = row
+        profile = json.loads(data)
+        profile["doc_id"] = doc_id
+        profile["hey"] = hey
+        return profile
+
+    def get_profile(self, user_id: str, ver: int) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT doc_id, data, hey FROM profiles WHERE id = ? AND ver = ?",
+                (user_id, ver),
+            ).fetchone()
+        return self._row_to_profile(row) if row else None
+
+    def get_profiles(self, keys: list) -> dict:
+        doc_ids = [profile_doc_id(user_id, ver) for user_id, ver in keys]
+        profiles = {}
+        with self._lock:
+            # SQLite の変数上限に収まるよう分割する
+            for i in range(0, len(doc_ids), MAX_BATCH_OPS):
+                chunk = doc_ids[i:i + MAX_BATCH_OPS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT doc_id, data, hey FROM profiles WHERE doc_id IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for row in rows:
+                    profile = self._row_to_profile(row)
+                    profiles[(profile.get("id"), profile.get("ver"))] = profile
+        return profiles
+
+    def create_profile(self, data: dict):
+        doc_id = profile_doc_id(data["id"], data["ver"])
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM profiles WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            merged = {**json.loads(row[0]), **data} if row else dict(data)
+            self._conn.execute(
+                """
+                INSERT INTO profiles (doc_id, id, ver, data) VALUES (?, ?, ?, ?)
+                ON CONFLICT(doc_id) DO UPDATE SET data = excluded.data
+                """,
+                (doc_id, data["id"], data["ver"], json.dumps(merged, default=_json_default)),
+            )
+            self._conn.commit()
+
+    def update_profile(self, user_id: str, ver: int, fields: dict):
+        self.create_profile({**fields, "id": user_id, "ver": ver})
+
+    def update_profiles(self, updates: dict) -> list:
+        # 1トランザクションで書く
+        failed = []
+        with self._lock:
+            for doc_id, fields in updates.items():
+                row = self._conn.execute(
+                    "SELECT data FROM profiles WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+                if row is None:
+                    failed.append(doc_id)
+                    continue
+                self._conn.execute(
+                    "UPDATE profiles SET data = ? WHERE doc_id = ?",
+                    (json.dumps({**json.loads(row[0]), **fields}, default=_json_default), doc_id),
+                )
+            self._conn.commit()
+        return failed
+
+    def get_hey_totals(self, keys: list) -> dict:
+        doc_ids = [profile_doc_id(user_id, ver) for user_id, ver in keys]
+        totals = {}
+        with self._lock:
+            for i in range(0, len(doc_ids), MAX_BATCH_OPS):
+                chunk = doc_ids[i:i + MAX_BATCH_OPS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT id, ver, hey FROM profiles WHERE doc_id IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for user_id, ver, hey in rows:
+                    totals[(user_id, ver)] = hey
+        return totals
+
+    def increment_hey(self, deltas: dict):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE profiles SET hey = hey + ? WHERE doc_id = ?",
+                [
+                    (delta, profile_doc_id(user_id, ver))
+                    for (user_id, ver), delta in deltas.items()
+                    if delta
+                ],
+            )
+            self._conn.commit()
+
+    def list_profiles(self, filters: dict | None = None, limit: int | None = None) -> list:
+        sql = "SELECT doc_id, data, hey FROM profiles"
+        params = []
+        conditions = []
+        for field, value in (filters or {}).items():
+            conditions.append(f"json_extract(data, '$.{field}') = ?")
+            params.append(value)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY doc_id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        return self._query_profiles(sql, params)
+
+    def _query_profiles(self, sql: str, params: list) -> list:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        profiles = []
+        for row in rows:
+            profile = self._row_to_profile(row)
+            profile.pop("hey")
+            profiles.append(profile)
+        return profiles
+
+    def scan_profiles(self, after: str | None, limit: int) -> list:
+        return self._query_profiles(
+            "SELECT doc_id, data, hey FROM profiles WHERE doc_id > ? ORDER BY doc_id LIMIT ?",
+            [after or "", limit],
+        )
+
+    @contextmanager
+    def _seq_transaction(self):
+        """
+        受信箱の seq は書き込みロックを取ってから振る
+        （小さい seq が後からコミットされて /sync に読み飛ばされないように）
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+
+    def add_encounters(self, observer: str, encounters: dict) -> int:
+        with self._lock, self._seq_transaction():
+            rows = [
+                (observer, peer_id, peer_ver, seen_at, next_seq())
+                for (peer_id, peer_ver), seen_at in encounters.items()
+            ]
+            self._conn.executemany(
+                """
+                INSERT INTO inbox (observer, peer_id, peer_ver, seen_at, count, seq)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT(observer, peer_id, peer_ver) DO UPDATE SET
+                    seen_at = max(coalesce(seen_at, 0), coalesce(excluded.seen_at, 0)),
+                    count = count + 1,
+                    seq = excluded.seq
+                """,
+                rows,
+            )
+        return rows[-1][-1] if rows else 0
+
+    def read_inbox(self, observer: str, since: int, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT peer_id, peer_ver, seen_at, count, seq FROM inbox
+                WHERE observer = ? AND seq > ? ORDER BY seq LIMIT ?
+                """,
+                (observer, since, limit),
+            ).fetchall()
+        return [
+            {"peer_id": peer_id, "peer_ver": peer_ver, "seen_at": seen_at, "count": count, "seq": seq}
+            for peer_id, peer_ver, seen_at, count, seq in rows
+        ]
+
+    def touch_encounters(self, peer_id: str, peer_ver: int) -> int:
+        with self._lock, self._seq_transaction():
+            observers = [
+                row[0] for row in self._conn.execute(
+                    "SELECT observer FROM inbox WHERE peer_id = ? AND peer_ver = ?",
+                    (peer_id, peer_ver),
+                )
+            ]
+            self._conn.executemany(
+                "UPDATE inbox SET seq = ? WHERE observer = ? AND peer_id = ? AND peer_ver = ?",
+                [(next_seq(), observer, peer_id, peer_ver) for observer in observers],
+            )
+        return len(observers)
+
+    def save_leaderboards(self, boards: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO leaderboards (name, entries, updated_at) VALUES (?, ?, ?)",
+                [
+                    (name, json.dumps(entries, ensure_ascii=False, default=_json_default), now)
+                    for name, entries in boards.items()
+                ],
+            )
+            self._conn.commit()
+
+    def load_leaderboards(self, names: list | None = None) -> dict:
+        with self._lock:
+            if names is None:
+                rows = self._conn.execute("SELECT name, entries FROM leaderboards").fetchall()
+            else:
+                placeholders = ",".join("?" * len(names))
+                rows = self._conn.execute(
+                    f"SELECT name, entries FROM leaderboards WHERE name IN ({placeholders})",
+                    list(names),
+                ).fetchall()
+        return {name: json.loads(entries) for name, entries in rows}
+
+
+# =====================
+# メモリ（単体の負荷試験用・プロセス終了で消える）
+# =====================
+class MemoryProfileStore(ProfileStore):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # doc_id → [data, hey]
+        self._profiles = {}
+        # observer → {(peer_id, peer_ver): 受信箱の項目}
+        self._inboxes = {}
+        # (peer_id, peer_ver) → そのカードを持つ observer
+        self._holders = {}
+        self._leaderboards = {}
+
+    def _get(self, doc_id: str) -> dict | None:
+        entry = self._profiles.get(doc_id)
+        if entry is None:
+            return None
+        return {**entry[0], "doc_id": doc_id, "hey": entry[1]}
+
+    def get_profile(self, user_id: str, ver: int) -> dict | None:
+        with self._lock:
+            return self._get(profile_doc_id(user_id, ver))
+
+    def get_profiles(self, keys: list) -> dict:
+        profiles = {}
+        with self._lock:
+            for user_id, ver in keys:
+                profile = self._get(profile_doc_id(user_id, ver))
+                if profile is not None:
+                    profiles[(user_id, ver)] = profile
+        return profiles
+
+    def create_profile(self, data: dict):
+        doc_id = profile_doc_id(data["id"], data["ver"])
+        with self._lock:
+            entry = self._profiles.setdefault(doc_id, [{}, 0])
+            entry[0] = {**entry[0], **data}
+
+    def update_profile(self, user_id: str, ver: int, fields: dict):
+        self.create_profile({**fields, "id": user_id, "ver": ver})
+
+    def update_profiles(self, updates: dict) -> list:
+        failed = []
+        with self._lock:
+            for doc_id, fields in updates.items():
+                entry = self._profiles.get(doc_id)
+                if entry is None:
+                    failed.append(doc_id)
+                    continue
+                entry[0] = {**entry[0], **fields}
+        return failed
+
+    def increment_hey(self, deltas: dict):
+        with self._lock:
+            for (user_id, ver), delta in deltas.items():
+                entry = self._profiles.get(profile_doc_id(user_id, ver))
+                if entry is not None:
+                    entry[1] += delta
+
+    def get_hey_totals(self, keys: list) -> dict:
+        totals = {}
+        with self._lock:
+            for key in keys:
+                entry = self._profiles.get(profile_doc_id(*key))
+                if entry is not None:
+                    totals[key] = entry[1]
+        return totals
+
+    # メモリ上の操作なのでスレッドに逃がさない
+    async def aget_profile(self, user_id: str, ver: int) -> dict | None:
+        return self.get_profile(user_id, ver)
+
+    async def aget_profiles(self, keys: list) -> dict:
+        return self.get_profiles(keys)
+
+    async def aget_hey_totals(self, keys: list) -> dict:
+        return self.get_hey_totals(keys)
+
+    def list_profiles(self, filters: dict | None = None, limit: int | None = None) -> list:
+        profiles = []
+        with self._lock:
+            for doc_id in sorted(self._profiles):
+                data = self._profiles[doc_id][0]
+                if all(data.get(k) == v for k, v in (filters or {}).items()):
+                    profiles.append({**data, "doc_id": doc_id})
+                    if limit is not None and len(profiles) >= limit:
+                        break
+        return profiles
+
+    def scan_profiles(self, after: str | None, limit: int) -> list:
+        with self._lock:
+            doc_ids = sorted(doc_id for doc_id in self._profiles if after is None or doc_id > after)
+            return [{**self._profiles[doc_id][0], "doc_id": doc_id} for doc_id in doc_ids[:limit]]
+
+    def add_encounters(self, observer: str, encounters: dict) -> int:
+        seq = 0
+        with self._lock:
+            inbox = self._inboxes.setdefault(observer, {})
+            for (peer_id, peer_ver), seen_at in encounters.items():
+                seq = next_seq()
+                entry = inbox.setdefault((peer_id, peer_ver), {
+                    "peer_id": peer_id, "peer_ver": peer_ver, "seen_at": seen_at, "count": 0,
+                })
+                entry["seen_at"] = max(entry["seen_at"] or 0, seen_at or 0)
+                entry["count"] += 1
+                entry["seq"] = seq
+                self._holders.setdefault((peer_id, peer_ver), set()).add(observer)
+        return seq
+
+    def read_inbox(self, observer: str, since: int, limit: int) -> list:
+        with self._lock:
+            entries = [
+                dict(entry) for entry in self._inboxes.get(observer, {}).values()
+                if entry["seq"] > since
+            ]
+        entries.sort(key=lambda entry: entry["seq"])
+        return entries[:limit]
+
+    def touch_encounters(self, peer_id: str, peer_ver: int) -> int:
+        with self._lock:
+            observers = self._holders.get((peer_id, peer_ver), set())
+            for observer in observers:
+                self._inboxes[observer][(peer_id, peer_ver)]["seq"] = next_seq()
+            return len(observers)
+
+    def save_leaderboards(self, boards: dict):
+        with self._lock:
+            for name, entries in boards.items():
+                self._leaderboards[name] = [dict(entry) for entry in entries]
+
+    def load_leaderboards(self, names: list | None = None) -> dict:
+        with self._lock:
+            return {
+                name: list(entries)
+                for name, entries in self._leaderboards.items()
+                if names is None or name in names
+            }
@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+try:
+    import brotli
+except ImportError:
+    # brotli が無ければ gzip だけを配る
+    brotli = None
+
+# =====================
+# 設定
+# =====================
+# アプリに同梱している JSON の置き場所（既定は起動したディレクトリによらずリポジトリ内）
+REFERENCE_DATA_DIR = os.getenv(
+    "REFERENCE_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "front", "my_app", "lib", "json"),
+)
+# バンドル名 → ファイル名
+BUNDLE_FILES = {
+    "birthday": "birthday.json",
+    "birthday_trivia": "birthday_trivia.json",
+    "prefecture": "prefecher.json",
+}
+
+_lock = threading.Lock()
+# バンドル名 → {"hash", "data", "identity", "gzip", "br"}
+_bundles = {}
+
+
+# =====================
+# 読み込み（起動時に1回）
+# =====================
+def _build(data) -> dict:
+    # 並び順はファイルのまま、空白だけ詰める
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    bundle = {
+        "hash": hashlib.sha256(raw).hexdigest()[:16],
+        "data": data,
+        "identity": raw,
+        # mtime=0 で同じ内容なら同じバイト列にする
+        "gzip": gzip.compress(raw, compresslevel=9, mtime=0),
+    }
+    if brotli is not None:
+        bundle["br"] = brotli.compress(raw, quality=11)
+    return bundle
+
+
+def load(directory: str = REFERENCE_DATA_DIR):
+    global _bundles
+    bundles = {}
+    for name, filename in BUNDLE_FILES.items():
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            bundles[name] = _build(json.load(f))
+    # 都道府県は大文字・小文字を無視して引けるようにする
+    bundles["prefecture"]["index"] = {key.lower(): key for key in bundles["prefecture"]["data"]}
+
+    with _lock:
+        _bundles = bundles
+    hashes = ", ".join(f"{name}={bundle['hash']}" for name, bundle in bundles.items())
+    print(f"--- reference data loaded: {hashes} ---")
+
+
+def get(name: str) -> dict | None:
+    with _lock:
+        return _bundles.get(name)
+
+
+def manifest(base_path: str) -> dict:
+    """{name: {hash, url, サイズ}}"""
+    with _lock:
+        bundles = dict(_bundles)
+    return {
+        name: {
+            "hash": bundle["hash"],
+            "url": f"{base_path}/{name}.{bundle['hash']}.json",
+            "size": len(bundle["identity"]),
+            "gzip_size": len(bundle["gzip"]),
+            "br_size": len(bundle["br"]) if "br" in bundle else None,
+        }
+        for name, bundle in bundles.items()
+    }
+
+
+# =====================
+# 圧縮形式の選択
+# =====================
+def choose_encoding(accept_encoding: str, bundle: dict) -> str:
+    """Accept-Encoding から br → gzip → そのまま の順に選ぶ"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        q = re.search(r"q=([0-9.]+)", params)
+        if q and float(q.group(1)) == 0:
+            continue
+        accepted.add(token.strip().lower())
+
+    for encoding in ("br", "gzip"):
+        if encoding in bundle and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+# =====================
+# 個別の参照
+# =====================
+def normalize_date(value: str) -> str | None:
+    """"1/1" "01-01" "0101" → "01/01"（不正なら None）"""
+    digits = re.findall(r"\d+", value)
+    if len(digits) == 1 and len(digits[0]) == 4:
+        digits = [digits[0][:2], digits[0][2:]]
+    if len(digits) != 2:
+        return None
+    month, day = int(digits[0]), int(digits[1])
+    if not (1 <= month <= 12 and 1 <= day <= 31):
+        return None
+    return f"{month:02d}/{day:02d}"
+
+
+def day(value: str) -> dict | None:
+    date = normalize_date(value)
+    if date is None:
+        return None
+    trivia = (get("birthday_trivia") or {}).get("data", {}).get(date)
+    flag = (get("birthday") or {}).get("data", {}).get(date)
+    if trivia is None and flag is None:
+        return None
+    return {"date": date, "trivia": trivia, "flag": flag}
+
+
+def prefecture(name: str) -> dict | None:
+    bundle = get("prefecture")
+    if bundle is None:
+        return None
+    key = bundle["index"].get(name.strip().lower())
+    if key is None:
+        return None
+    return {"prefecture": key, "flag": bundle["data"][key]}
@@ -0,0 +1,339 @@
+import base64
+import os
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# =====================
+# 設定
+# =====================
+# カンマ区切りで複数の SD WebUI を指定できる
+SD_BACKENDS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("SD_BACKENDS", "http://127.0.0.1:7860").split(",")
+    if url.strip()
+]
+SD_AUTH = (
+    os.getenv("SD_AUTH_USER", "user"),
+    os.getenv("SD_AUTH_PASSWORD", "password"),
+)
+SD_TIMEOUT_SEC = float(os.getenv("SD_TIMEOUT_SEC", "180"))
+# 1バックエンドあたりの keep-alive 接続数
+SD_POOL_SIZE = int(os.getenv("SD_POOL_SIZE", "8"))
+# ヘルスチェックの間隔と、切り離すまでの連続失敗回数
+SD_HEALTH_INTERVAL_SEC = float(os.getenv("SD_HEALTH_INTERVAL_SEC", "10"))
+SD_HEALTH_TIMEOUT_SEC = float(os.getenv("SD_HEALTH_TIMEOUT_SEC", "3"))
+SD_EJECT_AFTER_FAILURES = int(os.getenv("SD_EJECT_AFTER_FAILURES", "3"))
+# 画像をこのサイズまではメモリ、超えたら一時ファイルに置く
+SD_SPOOL_MAX_BYTES = int(os.getenv("SD_SPOOL_MAX_BYTES", str(1024 * 1024)))
+SD_STREAM_CHUNK_BYTES = 64 * 1024
+
+TXT2IMG_PATH = "/sdapi/v1/txt2img"
+IMG2IMG_PATH = "/sdapi/v1/img2img"
+PROGRESS_PATH = "/sdapi/v1/progress"
+
+
+class Backend:
+    """SD WebUI 1台分の接続と状態"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SD_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.auth = SD_AUTH
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+        self.requests = 0
+        self.errors = 0
+        self.latency_sec_ewma = None
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_sec_ewma": self.latency_sec_ewma,
+        }
+
+
+_backends = [Backend(url) for url in SD_BACKENDS]
+_lock = threading.Lock()
+_health_thread = None
+
+
+# =====================
+# ヘルスチェック
+# =====================
+def _mark_failure(backend: Backend):
+    with _lock:
+        backend.failures += 1
+        backend.errors += 1
+        if backend.failures >= SD_EJECT_AFTER_FAILURES and backend.healthy:
+            backend.healthy = False
+            print(f"SD backend ejected: {backend.url}")
+
+
+def _mark_success(backend: Backend):
+    with _lock:
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            print(f"SD backend re-admitted: {backend.url}")
+
+
+def probe(backend: Backend) -> bool:
+    try:
+        r = backend.session.get(
+            backend.url + PROGRESS_PATH,
+            params={"skip_current_image": "true"},
+            timeout=SD_HEALTH_TIMEOUT_SEC,
+        )
+        r.raise_for_status()
+    except requests.RequestException:
+        _mark_failure(backend)
+        return False
+    _mark_success(backend)
+    return True
+
+
+def _health_loop():
+    while True:
+        for backend in _backends:
+            probe(backend)
+        time.sleep(SD_HEALTH_INTERVAL_SEC)
+
+
+def _ensure_health_thread():
+    global _health_thread
+    if _health_thread is not None:
+        return
+    with _lock:
+        if _health_thread is None:
+            _health_thread = threading.Thread(target=_health_loop, name="sd-health", daemon=True)
+            _health_thread.start()
+
+
+# =====================
+# 振り分け
+# =====================
+def _acquire(exclude=()) -> Backend | None:
+    """処理中リクエストが最も少ない正常なバックエンドを選ぶ"""
+    with _lock:
+        candidates = [b for b in _backends if b.healthy and b not in exclude]
+        if not candidates:
+            # 全滅時は切り離し済みのものも試す
+            candidates = [b for b in _backends if b not in exclude]
+        if not candidates:
+            return None
+        backend = min(candidates, key=lambda b: b.outstanding)
+        backend.outstanding += 1
+        backend.requests += 1
+        return backend
+
+
+def _release(backend: Backend, latency: float | None):
+    with _lock:
+        backend.outstanding -= 1
+        if latency is not None:
+            if backend.latency_sec_ewma is None:
+                backend.latency_sec_ewma = latency
+            else:
+                backend.latency_sec_ewma = 0.8 * backend.latency_sec_ewma + 0.2 * latency
+
+
+def post(path: str, payload: dict, **kwargs) -> requests.Response:
+    """
+    空いているバックエンドに POST する。
+    接続できなかったとき・5xx が返ったときは、別のバックエンドで再試行する。
+    """
+    _ensure_health_thread()
+
+    tried = []
+    last_error = None
+    while True:
+        backend = _acquire(exclude=tried)
+        if backend is None:
+            if last_error is not None:
+                raise last_error
+            raise RuntimeError("No Stable Diffusion backend available")
+        tried.append(backend)
+
+        start = time.perf_counter()
+        latency = None
+        try:
+            r = backend.session.post(
+                backend.url + path,
+                json=payload,
+                timeout=SD_TIMEOUT_SEC,
+                **kwargs,
+            )
+            r.raise_for_status()
+            latency = time.perf_counter() - start
+        except requests.ConnectionError as e:
+            _mark_failure(backend)
+            last_error = e
+            continue
+        except requests.RequestException as e:
+            # 4xx はリクエスト側の問題なのでバックエンドは疑わない
+            response = getattr(e, "response", None)
+            if response is None or response.status_code >= 500:
+                _mark_failure(backend)
+            if response is not None and response.status_code >= 500:
+                # 混んでいる・調子の悪いバックエンドは飛ばして、空いている別のものに回す
+                response.close()
+                last_error = e
+                continue
+            raise
+        finally:
+            _release(backend, latency)
+
+        _mark_success(backend)
+        return r
+
+
+def txt2img(payload: dict) -> bytes:
+    r = post(TXT2IMG_PATH, payload)
+    return base64.b64decode(r.json()["images"][0])
+
+
+def img2img(payload: dict) -> bytes:
+    r = post(IMG2IMG_PATH, payload)
+    return base64.b64decode(r.json()["images"][0])
+
+
+# =====================
+# レスポンスを少しずつ読んで画像だけ取り出す
+# =====================
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+
+
+class _FirstImageDecoder:
+    """
+    {"images": ["<base64>", ...], "parameters": ..., "info": ...} を先頭から読み、
+    images[0] の base64 を少しずつデコードして out に書き込む。
+    JSON 全体や base64 文字列全体をメモリに載せない。
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.capturing_key = False
+        self.key = bytearray()
+        self.last_key = None
+        self.in_images = False
+        self.in_image = False
+        self.first_segment = True
+        self.carry = b""
+
+    def feed(self, data: bytes):
+        if self.in_image:
+            self._feed_image(data)
+            return
+
+        for i, c in enumerate(data):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == _BACKSLASH:
+                    self.escape = True
+                elif c == _QUOTE:
+                    self.in_string = False
+                    if self.capturing_key:
+                        self.last_key = bytes(self.key)
+                elif self.capturing_key and len(self.key) < 64:
+                    self.key.append(c)
+                continue
+
+            if c == _QUOTE:
+                if self.in_images and self.depth == 2:
+                    self.in_image = True
+                    self._feed_image(data[i + 1:])
+                    return
+                self.in_string = True
+                self.capturing_key = self.depth == 1 and self.expect_key
+                self.key.clear()
+            elif c in b"{[":
+                self.depth += 1
+                if c == ord("{") and self.depth == 1:
+                    self.expect_key = True
+                elif c == ord("[") and self.depth == 2 and self.last_key == b"images":
+                    self.in_images = True
+            elif c in b"}]":
+                self.depth -= 1
+                if self.depth <= 1:
+                    self.in_images = False
+            elif self.depth == 1 and c == ord(":"):
+                self.expect_key = False
+            elif self.depth == 1 and c == ord(","):
+                self.expect_key = True
+
+    def _feed_image(self, data: bytes):
+        end = data.find(b'"')
+        segment = data if end < 0 else data[:end]
+        # JSON で "/" が "\/" とエスケープされていても読めるように
+        segment = segment.replace(b"\\", b"")
+
+        if self.first_segment and segment:
+            self.first_segment = False
+            if segment.startswith(b"data:"):
+                segment = segment[segment.find(b",") + 1:]
+
+        buffer = self.carry + segment
+        usable = len(buffer) - len(buffer) % 4
+        if usable:
+            self.out.write(base64.b64decode(buffer[:usable]))
+        self.carry = buffer[usable:]
+
+        if end >= 0:
+            if self.carry:
+                self.out.write(base64.b64decode(self.carry + b"=" * (-len(self.carry) % 4)))
+                self.carry = b""
+            self.in_image = False
+            self.done = True
+
+
+def _stream_first_image(response) -> tempfile.SpooledTemporaryFile:
+    out = tempfile.SpooledTemporaryFile(max_size=SD_SPOOL_MAX_BYTES)
+    decoder = _FirstImageDecoder(out)
+    try:
+        for chunk in response.iter_content(SD_STREAM_CHUNK_BYTES):
+            decoder.feed(chunk)
+            if decoder.done:
+                break
+        if not decoder.done:
+            raise ValueError("No image in Stable Diffusion response")
+        # 残り（parameters / info）はデコードせずに読み捨てる（読み切らないと接続がプールに戻らない）
+        for _ in response.iter_content(SD_STREAM_CHUNK_BYTES):
+            pass
+    except BaseException:
+        out.close()
+        raise
+
+    out.seek(0)
+    return out
+
+
+def txt2img_stream(payload: dict) -> tempfile.SpooledTemporaryFile:
+    """txt2img の画像を、読み出し位置を先頭にしたファイルオブジェクトで返す"""
+    with closing(post(TXT2IMG_PATH, payload, stream=True)) as r:
+        return _stream_first_image(r)
+
+
+def stats() -> dict:
+    with _lock:
+        return {"backends": [b.snapshot() for b in _backends]}
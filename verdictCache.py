@@ -0,0 +1,195 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# =====================
+# 設定
+# =====================
+VERDICT_CACHE_PATH = os.getenv("VERDICT_CACHE_PATH", "cache/verdicts.sqlite3")
+# メモリ上に保持する件数
+VERDICT_CACHE_LRU_SIZE = int(os.getenv("VERDICT_CACHE_LRU_SIZE", "10000"))
+# ディスク上の有効期限と最大件数
+VERDICT_CACHE_TTL_SEC = int(os.getenv("VERDICT_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+VERDICT_CACHE_MAX_ROWS = int(os.getenv("VERDICT_CACHE_MAX_ROWS", "100000"))
+# プロンプトやモデルを変えたら上げる（古い判定を使わないため）
+VERDICT_CACHE_VERSION = os.getenv("VERDICT_CACHE_VERSION", "1")
+
+# 何件書き込むごとにディスクの掃除をするか
+_EVICT_EVERY = 256
+
+_lock = threading.Lock()
+_lru = OrderedDict()
+_conn = None
+_puts_since_evict = 0
+_stats = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "misses": 0,
+    "puts": 0,
+    "evictions": 0,
+}
+
+
+# =====================
+# キー
+# =====================
+def normalize(trivia: str) -> str:
+    """NFKC・大文字小文字・空白・句読点の違いを吸収する"""
+    text = unicodedata.normalize("NFKC", trivia).casefold()
+    return "".join(
+        ch for ch in text
+        if not ch.isspace() and not unicodedata.category(ch).startswith("P")
+    )
+
+
+def cache_key(trivia: str) -> str:
+    raw = f"{VERDICT_CACHE_VERSION}\0{normalize(trivia)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# =====================
+# SQLite
+# =====================
+def _db():
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(VERDICT_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(VERDICT_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS verdicts (
+                key TEXT PRIMARY KEY,
+                verdict INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS verdicts_accessed_at ON verdicts (accessed_at)"
+        )
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _lru_put(key: str, verdict: bool):
+    _lru[key] = verdict
+    _lru.move_to_end(key)
+    while len(_lru) > VERDICT_CACHE_LRU_SIZE:
+        _lru.popitem(last=False)
+
+
+def _evict_disk(conn, now: float):
+    """期限切れと、上限を超えた古いアクセス順の行を消す"""
+    cur = conn.execute(
+        "DELETE FROM verdicts WHERE created_at < ?",
+        (now - VERDICT_CACHE_TTL_SEC,),
+    )
+    evicted = cur.rowcount
+
+    (count,) = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+    overflow = count - VERDICT_CACHE_MAX_ROWS
+    if overflow > 0:
+        cur = conn.execute(
+            """
+            DELETE FROM verdicts WHERE key IN (
+                SELECT key FROM verdicts ORDER BY accessed_at LIMIT ?
+            )
+            """,
+            (overflow,),
+        )
+        evicted += cur.rowcount
+
+    _stats["evictions"] += evicted
+
+
+# =====================
+# 参照・登録
+# =====================
+def get(trivia: str) -> bool | None:
+    """キャッシュ済みの判定を返す。なければ None"""
+    key = cache_key(trivia)
+    now = time.time()
+
+    with _lock:
+        if key in _lru:
+            _lru.move_to_end(key)
+            _stats["memory_hits"] += 1
+            return _lru[key]
+
+        conn = _db()
+        row = conn.execute(
+            "SELECT verdict, created_at FROM verdicts WHERE key = ?",
+            (key,),
+        ).fetchone()
+
+        if row is None or row[1] < now - VERDICT_CACHE_TTL_SEC:
+            _stats["misses"] += 1
+            return None
+
+        conn.execute(
+            "UPDATE verdicts SET accessed_at = ? WHERE key = ?",
+            (now, key),
+        )
+        conn.commit()
+
+        verdict = bool(row[0])
+        _lru_put(key, verdict)
+        _stats["disk_hits"] += 1
+        return verdict
+
+
+def put(trivia: str, verdict: bool | None):
+    """判定を保存する（判断不能の None は保存しない）"""
+    global _puts_since_evict
+    if verdict is None:
+        return
+
+    key = cache_key(trivia)
+    now = time.time()
+
+    with _lock:
+        _lru_put(key, verdict)
+
+        conn = _db()
+        conn.execute(
+            """
+            INSERT INTO verdicts (key, verdict, created_at, accessed_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                verdict = excluded.verdict,
+                created_at = excluded.created_at,
+                accessed_at = excluded.accessed_at
+            """,
+            (key, int(verdict), now, now),
+        )
+
+        _stats["puts"] += 1
+        _puts_since_evict += 1
+        if _puts_since_evict >= _EVICT_EVERY:
+            _puts_since_evict = 0
+            _evict_disk(conn, now)
+
+        conn.commit()
+
+
+# =====================
+# 統計
+# =====================
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["memory_size"] = len(_lru)
+    lookups = snapshot["memory_hits"] + snapshot["disk_hits"] + snapshot["misses"]
+    hits = snapshot["memory_hits"] + snapshot["disk_hits"]
+    snapshot["hit_ratio"] = hits / lookups if lookups else 0.0
+    return snapshot